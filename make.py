@@ -31,7 +31,7 @@ from zipfile import ZipFile, ZIP_DEFLATED
 APP_VERSION = 306
 
 # a list of all supported operations
-SUPPORTED_OPERATIONS = ["clean", "build", "run", "dist"]
+SUPPORTED_OPERATIONS = ["clean", "build", "run", "test", "dist"]
 
 # what operations to run by default
 DEFAULT_OPERATIONS = ["clean", "build", "run"]
@@ -41,6 +41,9 @@ PYTHON_SRC_PATH = "src"
 RESOURCE_SRC_PATH = "resources"
 UI_SRC_PATH = "ui"
 
+# folder where the unit tests live
+TESTS_PATH = "tests"
+
 # folder to compile into
 BUILD_DIR = "build"
 
@@ -217,6 +220,16 @@ class Operations:
         os.system("{} {}".format(sys.executable, os.path.join(BUILD_DIR, MAIN_SCRIPT)))
 
 
+    @staticmethod
+    def test():
+        # run the unit tests against the build directory (which also has the generated files such as _version.py)
+        import subprocess
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(BUILD_DIR))
+        if subprocess.call([sys.executable, "-m", "unittest", "discover", "-s", TESTS_PATH], env=env) != 0:
+            print("Unit tests failed")
+            sys.exit(1)
+
+
     @staticmethod
     def dist_win():
         assert(sys.platform.startswith("win32"))
@@ -0,0 +1,140 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# General python modules
+from hashlib import sha256
+import json
+import logging
+import os
+import threading
+
+
+class AddonCache:
+    """
+    A local cache of addon packages (zips) so reinstalling an addon, going back to a version we had before or installing
+    into another WoW folder doesn't need a download. Each package is stored once under the sha256 of its contents, with an
+    index from each addon name and version to the package. The least recently used packages are removed once the cache
+    is over `max_size` bytes.
+    """
+    _INDEX_FILE_NAME = "index.json"
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._index = {}
+        if not self._path:
+            return
+        os.makedirs(self._path, exist_ok=True)
+        try:
+            with open(os.path.join(self._path, self._INDEX_FILE_NAME), encoding="utf8") as f:
+                self._index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.getLogger().error("Failed to load addon cache index: {}".format(str(e)))
+
+
+    def _get_key(self, name, version):
+        return "{}/{}".format(name, version)
+
+
+    def _get_file_path(self, content_hash):
+        return os.path.join(self._path, content_hash + ".zip")
+
+
+    def _save_index(self):
+        path = os.path.join(self._path, self._INDEX_FILE_NAME)
+        try:
+            with open(path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(self._index, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.getLogger().error("Failed to save addon cache index: {}".format(str(e)))
+
+
+    def get(self, name, version):
+        # returns the cached package for this version of the addon (or None)
+        if not self._path:
+            return None
+        with self._lock:
+            content_hash = self._index.get(self._get_key(name, version))
+        if not content_hash:
+            return None
+        path = self._get_file_path(content_hash)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # update the modified time so we remove the least recently used packages first
+            os.utime(path)
+        except OSError:
+            return None
+        if sha256(data).hexdigest() != content_hash:
+            logging.getLogger().error("Cached addon package is corrupt ({} {})".format(name, version))
+            self._remove(path)
+            return None
+        return data
+
+
+    def put(self, name, version, data):
+        if not self._path:
+            return
+        content_hash = sha256(data).hexdigest()
+        path = self._get_file_path(content_hash)
+        with self._lock:
+            try:
+                if os.path.isfile(path):
+                    os.utime(path)
+                else:
+                    with open(path + ".tmp", "wb") as f:
+                        f.write(data)
+                    os.replace(path + ".tmp", path)
+            except OSError as e:
+                logging.getLogger().error("Failed to cache addon package ({} {}): {}".format(name, version, str(e)))
+                return
+            self._index[self._get_key(name, version)] = content_hash
+            self._trim()
+            self._save_index()
+
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+    def _trim(self):
+        # remove the least recently used packages until we're within the size limit (and drop what referenced them)
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self._path):
+            if not file_name.endswith(".zip"):
+                continue
+            path = os.path.join(self._path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            self._remove(path)
+            total_size -= size
+        self._index = {key: value for key, value in self._index.items() if os.path.isfile(self._get_file_path(value))}
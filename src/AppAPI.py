@@ -15,30 +15,52 @@
 
 
 # Local modules
+from CircuitBreaker import CircuitBreaker
 import Config
+from GroupSnapshots import GroupSnapshots, get_groups_diff
+from HttpCache import HttpCache
+from HttpPool import HttpPool
 import PrivateConfig
+from RetryPolicy import RetryPolicy
+from SalesFormat import encode_sales, split_sales
+from TokenBucket import TokenBucket
+from UploadWatermarks import UploadWatermarks, get_content_hash
 
 # General python modules
 from base64 import b64encode
+import codecs
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
 from hashlib import md5, sha1, sha256, sha512
-from gzip import GzipFile
-from io import BytesIO, StringIO
+from functools import partial
+from io import StringIO, TextIOBase
 import http
 import json
 import logging
-import socket
-from time import time
+import os
+import re
+from shutil import copyfileobj
+import threading
+from time import sleep, time
 from urllib.parse import quote, urlencode
-from urllib.request import Request, urlopen
 from urllib.error import HTTPError, URLError
+import zlib
 
 
+_STREAM_CHUNK_SIZE = 64 * 1024
+# realm data can be sent in a compact format (the raw Lua value) instead of being escaped inside of a JSON string
+_RAW_DATA_ACCEPT = "application/octet-stream, application/json;q=0.9"
+# uploads to these endpoints are keyed by region first (which isn't encoded like the other names are)
+_REGION_ENDPOINTS = ("black_market", "wow_token", "sales")
 _DEFAULT_USER_INFO = {
     'session': "",
     'userId': 0,
     'name': "",
     'isPremium': False,
 }
+# the fields of the user info which the server includes in status responses
+_REFRESHED_USER_INFO_KEYS = ("name", "isPremium", "endpointSubdomains")
 
 
 class ApiError(Exception):
@@ -46,48 +68,369 @@ class ApiError(Exception):
     pass
 
 
+class ApiSessionError(ApiError):
+    # raised when the server rejects our session (so we need to login again)
+    pass
+
+
 class ApiTransientError(Exception):
     # raised when we get an unexpected response from the server (and should generally just try again later)
     def __init__(self, message="Failed to connect to the server"):
         Exception.__init__(self, message)
 
 
+def _iter_gzip(chunks):
+    # gzips the chunks on the fly (text chunks are encoded as UTF-8)
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _iter_throttled(chunks, limiter):
+    # waits for the limiter before passing on each chunk
+    for chunk in chunks:
+        limiter.consume(len(chunk))
+        yield chunk
+
+
+class _ThrottledStream:
+    # a file-like object which limits how fast a response is read
+    def __init__(self, src, limiter):
+        self._src = src
+        self._limiter = limiter
+
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # read it in chunks so the limiter can spread it out
+            return b"".join(iter(partial(self.read, _STREAM_CHUNK_SIZE), b""))
+        data = self._src.read(size)
+        self._limiter.consume(len(data))
+        return data
+
+
+class _GzipStream:
+    # a file-like object which decompresses a gzipped response as it's read
+    def __init__(self, src):
+        self._src = src
+        self._decompressor = zlib.decompressobj(wbits=31)
+        self._buffer = b""
+        self._eof = False
+
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._src.read(_STREAM_CHUNK_SIZE)
+            if data:
+                self._buffer += self._decompressor.decompress(data)
+            else:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+                if not self._decompressor.eof:
+                    raise OSError("Truncated gzip response")
+        if size < 0:
+            size = len(self._buffer)
+        result = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return result
+
+
+class _JsonDataStream:
+    # incrementally extracts the (potentially very large) string value of the "data" key from a JSON response,
+    # writing it to `dst` as UTF-8 and keeping the rest of the response so it can be decoded separately
+    _DATA_START_RE = re.compile(r'"data"\s*:\s*"')
+    _SPECIAL_RE = re.compile(r'["\\]')
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, dst):
+        self._dst = dst
+        self._prefix = ""
+        self._suffix = ""
+        self._pending = ""
+        self._in_string = False
+        self._done = False
+
+
+    def feed(self, text):
+        if self._done:
+            self._suffix += text
+            return
+        if not self._in_string:
+            self._prefix += text
+            match = self._DATA_START_RE.search(self._prefix)
+            if not match:
+                return
+            text = self._prefix[match.end():]
+            self._prefix = self._prefix[:match.end()-1]
+            self._in_string = True
+        text = self._pending + text
+        self._pending = ""
+        result = []
+        i = 0
+        while i < len(text):
+            match = self._SPECIAL_RE.search(text, i)
+            if not match:
+                result.append(text[i:])
+                break
+            result.append(text[i:match.start()])
+            i = match.start()
+            if text[i] == '"':
+                # this is the end of the string
+                self._done = True
+                self._suffix = text[i+1:]
+                break
+            escape_length = 2
+            if text[i+1:i+2] == 'u':
+                # unicode escapes may be a surrogate pair
+                escape_length = 12 if 0xD800 <= int(text[i+2:i+6] or "0", 16) < 0xDC00 else 6
+            if len(text) - i < escape_length:
+                # wait for the rest of this escape sequence
+                self._pending = text[i:]
+                break
+            if escape_length == 2:
+                result.append(self._ESCAPES[text[i+1]])
+            else:
+                result.append(json.loads('"{}"'.format(text[i:i+escape_length])))
+            i += escape_length
+        self._dst.write("".join(result).encode("utf-8"))
+
+
+    def is_done(self):
+        return self._done
+
+
+    def get_remainder(self):
+        # returns the response with the data string removed
+        if not self._done:
+            return self._prefix
+        return self._prefix + '""' + self._suffix
+
+
 class AppAPI:
     def __init__(self):
         self._last_login = 0
+        self._session_expires = 0
+        self._email_hash = None
         self._user_info = _DEFAULT_USER_INFO.copy()
-        socket.setdefaulttimeout(30)
+        self._pool = HttpPool((Config.HTTP_CONNECT_TIMEOUT_S, Config.HTTP_READ_TIMEOUT_S), Config.HTTP_IDLE_TIMEOUT_S, Config.DNS_CACHE_TTL_S)
+        self._executor = ThreadPoolExecutor(Config.API_MAX_WORKERS)
+        # hedged requests get their own threads so they can't be starved by the requests which are waiting on them
+        self._hedge_executor = ThreadPoolExecutor(Config.API_MAX_WORKERS * 2)
+        self._latencies = {}
+        self._latencies_lock = threading.Lock()
+        self._deadline = None
+        self._cache = HttpCache(Config.HTTP_CACHE_DIR_PATH, Config.HTTP_CACHE_MAX_SIZE)
+        self._watermarks = UploadWatermarks(Config.UPLOAD_WATERMARKS_PATH, Config.UPLOAD_RECONCILE_INTERVAL_S)
+        self._group_snapshots = GroupSnapshots(Config.GROUP_SNAPSHOT_DIR_PATH)
+        self._retry_policy = RetryPolicy(Config.API_RETRY_BASE_DELAY_S, Config.API_RETRY_MAX_DELAY_S, Config.API_MAX_RETRIES)
+        self._circuit_breakers = {}
+        self._circuit_breakers_lock = threading.Lock()
+        self._host_semaphores = {}
+        self._host_semaphores_lock = threading.Lock()
+        self._bulk_semaphore = threading.BoundedSemaphore(Config.API_MAX_BULK_REQUESTS)
+        self._is_wow_running = False
+        self._upload_limiter = TokenBucket(Config.UPLOAD_RATE_LIMIT_BPS)
+        self._download_limiter = TokenBucket(Config.DOWNLOAD_RATE_LIMIT_BPS)
 
 
     def _make_request(self, *args, **kwargs):
+        endpoint = args[0]
+        if endpoint not in ("login", "log") and not self.has_endpoint(endpoint):
+            raise ApiTransientError("Endpoint disabled.")
+        # check the deadline first so running out of time doesn't count against the endpoint
+        self._get_timeout(endpoint)
+        circuit_breaker = self._get_circuit_breaker(endpoint)
+        if not circuit_breaker.allow_request():
+            raise ApiTransientError("The {} endpoint is currently unavailable".format(endpoint))
+        try:
+            return self._make_request_with_retries(circuit_breaker, endpoint, args, kwargs)
+        finally:
+            # a trial request must never be left pending (which would keep the endpoint down)
+            circuit_breaker.release_trial()
+
+
+    def _make_request_with_retries(self, circuit_breaker, endpoint, args, kwargs):
+        # only requests which don't upload or stream anything can safely be retried (or hedged)
+        can_retry = kwargs.get('data') is None and kwargs.get('dst') is None
+        attempt = 0
+        while True:
+            try:
+                kwargs['timeout'] = self._get_timeout(endpoint)
+                if can_retry and endpoint in Config.API_HEDGED_ENDPOINTS:
+                    result = self._make_hedged_request(endpoint, args, kwargs)
+                else:
+                    result = self._make_timed_request(endpoint, args, kwargs)
+            except ApiError:
+                # we got a response from the server, so it's up
+                circuit_breaker.record_success()
+                raise
+            except ApiTransientError:
+                delay = self._retry_policy.get_delay(attempt)
+                if not can_retry or attempt >= self._retry_policy.max_retries or (self._deadline and time() + delay >= self._deadline):
+                    circuit_breaker.record_failure()
+                    raise
+                logging.getLogger().info("Retrying {} request in {:.1f}s".format(endpoint, delay))
+                sleep(delay)
+                attempt += 1
+                continue
+            circuit_breaker.record_success()
+            return result
+
+
+    def set_deadline(self, deadline):
+        # requests are cut short so they don't go past this time (as returned by time()) - None removes the deadline
+        self._deadline = deadline
+
+
+    def set_wow_running(self, is_running):
+        # bulk transfers are limited more while WoW is running
+        if is_running == self._is_wow_running:
+            return
+        self._is_wow_running = is_running
+        if is_running:
+            logging.getLogger().info("WoW is running, so limiting bulk transfers")
+            self._upload_limiter.set_rate(Config.WOW_RUNNING_UPLOAD_RATE_LIMIT_BPS)
+            self._download_limiter.set_rate(Config.WOW_RUNNING_DOWNLOAD_RATE_LIMIT_BPS)
+        else:
+            logging.getLogger().info("WoW is no longer running")
+            self._upload_limiter.set_rate(Config.UPLOAD_RATE_LIMIT_BPS)
+            self._download_limiter.set_rate(Config.DOWNLOAD_RATE_LIMIT_BPS)
+
+
+    def _get_timeout(self, endpoint):
+        # returns the (connect, read) timeout for a request to the endpoint
+        connect_timeout, read_timeout = Config.API_ENDPOINT_TIMEOUTS.get(endpoint, (Config.HTTP_CONNECT_TIMEOUT_S, Config.HTTP_READ_TIMEOUT_S))
+        if self._deadline:
+            remaining = self._deadline - time()
+            if remaining <= 0:
+                raise ApiTransientError("Ran out of time for the {} request".format(endpoint))
+            connect_timeout = min(connect_timeout, remaining)
+            read_timeout = min(read_timeout, remaining)
+        return connect_timeout, read_timeout
+
+
+    def _make_timed_request(self, endpoint, args, kwargs):
+        start_time = time()
+        result = self._make_request_once(*args, **kwargs)
+        with self._latencies_lock:
+            if endpoint not in self._latencies:
+                self._latencies[endpoint] = deque(maxlen=Config.API_LATENCY_SAMPLES)
+            self._latencies[endpoint].append(time() - start_time)
+        return result
+
+
+    def _get_hedge_delay(self, endpoint):
+        # returns how long to wait for a response before sending a second request (based on recent latencies)
+        with self._latencies_lock:
+            latencies = sorted(self._latencies.get(endpoint, []))
+        if len(latencies) < Config.API_HEDGE_MIN_SAMPLES:
+            return Config.API_HEDGE_DEFAULT_DELAY_S
+        return latencies[min(int(len(latencies) * Config.API_HEDGE_PERCENTILE), len(latencies) - 1)]
+
+
+    def _make_hedged_request(self, endpoint, args, kwargs):
+        # if the request is taking longer than usual, send a second one and use whichever response comes back first
+        futures = [self._hedge_executor.submit(self._make_timed_request, endpoint, args, kwargs)]
+        if not wait(futures, timeout=self._get_hedge_delay(endpoint))[0]:
+            logging.getLogger().debug("Sending hedged {} request".format(endpoint))
+            futures.append(self._hedge_executor.submit(self._make_timed_request, endpoint, args, kwargs))
+        error = None
+        while futures:
+            done = wait(futures, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                futures.remove(future)
+                error = future.exception()
+                if not error:
+                    return future.result()
+                elif isinstance(error, ApiError):
+                    raise error
+        raise error
+
+
+    def _get_circuit_breaker(self, endpoint):
+        with self._circuit_breakers_lock:
+            if endpoint not in self._circuit_breakers:
+                self._circuit_breakers[endpoint] = CircuitBreaker(endpoint, Config.CIRCUIT_BREAKER_THRESHOLD, Config.CIRCUIT_BREAKER_COOLOFF_S, Config.CIRCUIT_BREAKER_MAX_COOLOFF_S)
+            return self._circuit_breakers[endpoint]
+
+
+    def is_endpoint_down(self, endpoint):
+        # returns whether requests to the endpoint are currently being skipped by its circuit breaker
+        return self._get_circuit_breaker(endpoint).is_open()
+
+
+    def _make_request_once(self, *args, **kwargs):
         endpoint = args[0]
         data = kwargs.pop('data', None)
+        # if a file object is passed as `dst`, binary responses are streamed into it rather than returned
+        dst = kwargs.pop('dst', None)
+        accept = kwargs.pop('accept', None)
+        timeout = kwargs.pop('timeout', None)
         assert(not kwargs)
         headers = {
             'Accept-Encoding': 'gzip',
         }
+        if accept:
+            headers['Accept'] = accept
+        body = None
         if data:
+            # request bodies are sent in chunks (and gzipped on the fly) so we don't need to hold them in memory
             should_gzip = True
             if type(data) == str:
                 headers['Content-Type'] = "text/plain"
+                get_chunks = lambda: [data]
             elif type(data) == bytes:
                 headers['Content-Type'] = "application/octet-stream"
                 should_gzip = False
+                body = data
             elif type(data) in [list, dict]:
-                data = json.dumps(data)
                 headers['Content-Type'] = "application/json"
+                get_chunks = lambda: json.JSONEncoder(separators=(",", ":")).iterencode(data)
+            elif hasattr(data, "read"):
+                # binary files (i.e. zips) are already compressed, so they're sent as-is
+                is_text = isinstance(data, TextIOBase)
+                headers['Content-Type'] = "text/plain" if is_text else "application/octet-stream"
+                should_gzip = is_text
+                start_pos = data.tell()
+                def get_chunks():
+                    # rewind the file in case this is a retry
+                    data.seek(start_pos)
+                    return iter(partial(data.read, _STREAM_CHUNK_SIZE), "" if is_text else b"")
+            elif hasattr(data, "__next__"):
+                headers['Content-Type'] = "text/plain"
+                sent = []
+                def get_chunks():
+                    # a generator can only be sent once
+                    if sent:
+                        raise OSError("Can't resend a generator request body")
+                    sent.append(True)
+                    return data
             else:
                 raise Exception("Invalid data type ({})!".format(type(data)))
             if should_gzip:
-                # gzip the data
-                buffer = BytesIO()
-                with GzipFile(fileobj=buffer, mode="wb") as f:
-                    f.write(bytes(data, 'UTF-8'))
-                data = buffer.getvalue()
                 headers['Content-Encoding'] = "gzip"
+                body = lambda: _iter_gzip(get_chunks())
+            elif body is None:
+                body = get_chunks
+            if self._upload_limiter.get_rate():
+                # send the body in chunks as fast as the limiter allows
+                if type(body) == bytes:
+                    get_body = lambda: (data[i:i+_STREAM_CHUNK_SIZE] for i in range(0, len(data), _STREAM_CHUNK_SIZE))
+                else:
+                    get_body = body
+                body = lambda: _iter_throttled(get_body(), self._upload_limiter)
+        # uploads and large downloads are limited so they don't hold up small requests (or use all the bandwidth)
+        is_bulk = data is not None or dst is not None or endpoint in Config.API_BULK_ENDPOINTS
+        # the session may be cleared by another thread while we're making the request, so use a consistent copy of it
+        user_info = self._user_info
         current_time = int(time())
         query_params = {
-            'session': self._user_info['session'],
+            'session': user_info['session'],
             'version': Config.CURRENT_VERSION,
             'time': current_time,
             'token': sha256("{}:{}:{}".format(Config.CURRENT_VERSION, current_time, PrivateConfig.get_token_salt()).encode("utf-8")).hexdigest()
@@ -95,46 +438,141 @@ class AppAPI:
         if endpoint in ("login", "log"):
             subdomain = "app-server"
         else:
-            if endpoint not in self._user_info['endpointSubdomains']:
+            if 'endpointSubdomains' not in user_info:
+                raise ApiSessionError("Session is no longer valid")
+            if endpoint not in user_info['endpointSubdomains']:
                 raise ApiTransientError("Endpoint disabled.")
-            subdomain = self._user_info['endpointSubdomains'][endpoint]
+            subdomain = user_info['endpointSubdomains'][endpoint]
         url = "http://{}.tradeskillmaster.com/v2/{}?{}".format(subdomain, "/".join([quote(a) for a in args]), urlencode(query_params))
+        cache_key = None
+        if body is None and not dst and endpoint in Config.HTTP_CACHE_ENDPOINTS:
+            # make a conditional request so the server can tell us to use our cached response
+            cache_key = "{}/{}".format(user_info['userId'], "/".join(args))
+            headers.update(self._cache.get_validators(cache_key))
         logger = logging.getLogger()
         logger.debug("Making request: {}".format(url))
-        try:
-            with urlopen(Request(url, headers=headers, data=data)) as response:
-                content_type = response.info().get_content_type()
-                raw_data = response.read()
-                if response.info().get("Content-Encoding") == "gzip":
-                    with GzipFile(fileobj=BytesIO(raw_data), mode="rb") as f:
-                        raw_data = f.read()
-                if content_type == "application/zip" or content_type == "application/octet-stream":
-                    return raw_data
-                elif content_type == "application/json":
-                    raw_data = raw_data.decode(response.info().get_param("charset", "utf-8"))
-                    data = json.loads(raw_data)
-                    if not data:
-                        # the data is invalid
-                        logger.error("Invalid data: '{}'".format(raw_data))
-                        raise ApiTransientError()
-                    elif not data.pop("success", False):
-                        # this request failed and we got an error back
-                        raise ApiError(data['error'])
-                    # this request was successful
-                    return data
-        except Exception as e:
-            # the request failed (weren't able to connect to the server)
-            if isinstance(e, ApiError) or isinstance(e, ApiTransientError):
-                raise
-            if isinstance(e, HTTPError):
-                logger.error("Got HTTP status code of {} ({})".format(e.code, e.reason))
-            elif isinstance(e, URLError):
-                logger.error("Error while making HTTP request ({})".format(e.reason))
-            else:
-                logger.error("Error while making HTTP request ({})".format(str(e)))
+        # (an empty ExitStack doesn't do anything, so is used when the request isn't limited)
+        with self._bulk_semaphore if is_bulk else ExitStack(), self._get_host_semaphore(subdomain):
+            try:
+                with self._pool.request(url, body, headers, timeout) as response:
+                    if response.status == 304:
+                        cached = self._cache.get(cache_key) if cache_key else None
+                        if not cached:
+                            logger.error("Got unexpected 304 response")
+                            raise ApiTransientError()
+                        logger.debug("Using cached response")
+                        if isinstance(cached[1], dict):
+                            cached[1].pop("success", None)
+                        return cached[1]
+                    content_type = response.info().get_content_type()
+                    response_stream = response
+                    if is_bulk and self._download_limiter.get_rate():
+                        response_stream = _ThrottledStream(response_stream, self._download_limiter)
+                    if response.info().get("Content-Encoding") == "gzip":
+                        response_stream = _GzipStream(response_stream)
+                    if content_type == "application/zip" or content_type == "application/octet-stream":
+                        if dst:
+                            copyfileobj(response_stream, dst)
+                            return True
+                        raw_data = response_stream.read()
+                        if cache_key:
+                            self._cache.put(cache_key, response.info(), content_type, raw_data)
+                        return raw_data
+                    elif content_type == "application/json":
+                        charset = response.info().get_param("charset", "utf-8")
+                        if dst:
+                            # stream the 'data' string into `dst` so we only decode the (small) rest of the response
+                            data_stream = _JsonDataStream(dst)
+                            decoder = codecs.getincrementaldecoder(charset)()
+                            while True:
+                                chunk = response_stream.read(_STREAM_CHUNK_SIZE)
+                                data_stream.feed(decoder.decode(chunk, not chunk))
+                                if not chunk:
+                                    break
+                            raw_data = data_stream.get_remainder()
+                        else:
+                            raw_data = response_stream.read().decode(charset)
+                        data = json.loads(raw_data)
+                        if not data:
+                            # the data is invalid
+                            logger.error("Invalid data: '{}'".format(raw_data))
+                            raise ApiTransientError()
+                        elif not data.pop("success", False):
+                            # this request failed and we got an error back
+                            if data.get('invalidSession'):
+                                self._clear_session()
+                                raise ApiSessionError(data['error'])
+                            raise ApiError(data['error'])
+                        elif dst and not data_stream.is_done():
+                            logger.error("Invalid data: '{}'".format(raw_data))
+                            raise ApiTransientError()
+                        # this request was successful
+                        if cache_key:
+                            self._cache.put(cache_key, response.info(), content_type, raw_data.encode("utf8"), data)
+                        return data
+            except Exception as e:
+                # the request failed (weren't able to connect to the server)
+                if isinstance(e, ApiError) or isinstance(e, ApiTransientError):
+                    raise
+                if isinstance(e, HTTPError) and e.code == 401 and endpoint != "login":
+                    self._clear_session()
+                    raise ApiSessionError("Session is no longer valid")
+                elif isinstance(e, HTTPError):
+                    logger.error("Got HTTP status code of {} ({})".format(e.code, e.reason))
+                elif isinstance(e, URLError):
+                    logger.error("Error while making HTTP request ({})".format(e.reason))
+                else:
+                    logger.error("Error while making HTTP request ({})".format(str(e)))
         raise ApiTransientError()
 
 
+    def _get_host_semaphore(self, subdomain):
+        # limits how many requests we make to a single host at once
+        with self._host_semaphores_lock:
+            if subdomain not in self._host_semaphores:
+                self._host_semaphores[subdomain] = threading.BoundedSemaphore(Config.API_MAX_REQUESTS_PER_HOST)
+            return self._host_semaphores[subdomain]
+
+
+    def run_concurrently(self, calls):
+        # runs each (function, *args) tuple in `calls` on the request thread pool and returns a list of (result, error)
+        # tuples in the same order as `calls`, where error is the ApiError / ApiTransientError raised (if any)
+        futures = [self._executor.submit(*call) for call in calls]
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except (ApiError, ApiTransientError) as e:
+                results.append((None, e))
+        return results
+
+
+    def run_as_completed(self, calls, max_running):
+        # like run_concurrently(), but yields (index, result, error) tuples as the calls finish, starting them in order
+        # with at most `max_running` running at once (so later calls can't get ahead of earlier ones)
+        pending = deque(enumerate(calls))
+        running = {}
+        while pending or running:
+            while pending and len(running) < max_running:
+                i, call = pending.popleft()
+                running[self._executor.submit(*call)] = i
+            for future in wait(running, return_when=FIRST_COMPLETED)[0]:
+                i = running.pop(future)
+                try:
+                    yield i, future.result(), None
+                except (ApiError, ApiTransientError) as e:
+                    yield i, None, e
+
+
+    def has_endpoint(self, endpoint):
+        return endpoint in self._user_info.get('endpointSubdomains', {})
+
+
+    def get_request_timings(self):
+        # returns a list of (path, seconds, reused_connection) for the most recent requests
+        return self._pool.get_timings()
+
+
     def get_username(self):
         return self._user_info['name']
 
@@ -144,7 +582,7 @@ class AppAPI:
 
 
     def logout(self):
-        self._user_info = _DEFAULT_USER_INFO
+        self._clear_session()
 
 
     def login(self, email, password):
@@ -152,10 +590,74 @@ class AppAPI:
         password_hash = sha512((password + PrivateConfig.get_password_salt()).encode("utf-8")).hexdigest()
         self._user_info = self._make_request("login", email_hash, password_hash)
         self._last_login = time()
+        self._session_expires = self._user_info.pop('sessionExpires', self._last_login + Config.SESSION_MAX_AGE_S)
+        self._email_hash = email_hash
+        self._save_session(email_hash)
+
+
+    def has_valid_session(self):
+        return bool(self._user_info['session']) and time() < self._session_expires
+
+
+    def restore_session(self, email):
+        # loads the session which was saved after the last login (if it's for the same user and hasn't expired)
+        if not Config.SESSION_FILE_PATH or not os.path.isfile(Config.SESSION_FILE_PATH):
+            return False
+        try:
+            with open(Config.SESSION_FILE_PATH, encoding="utf8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.getLogger().error("Failed to load saved session: {}".format(str(e)))
+            return False
+        if saved.get('email') != sha256(email.lower().encode("utf-8")).hexdigest() or saved.get('expires', 0) <= time():
+            return False
+        self._user_info = saved['userInfo']
+        self._session_expires = saved['expires']
+        self._email_hash = saved['email']
+        return True
+
+
+    def _save_session(self, email_hash):
+        if not Config.SESSION_FILE_PATH:
+            return
+        saved = {'email': email_hash, 'expires': self._session_expires, 'userInfo': self._user_info}
+        try:
+            # only the current user should be able to read the session
+            fd = os.open(Config.SESSION_FILE_PATH + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf8") as f:
+                json.dump(saved, f)
+            os.replace(Config.SESSION_FILE_PATH + ".tmp", Config.SESSION_FILE_PATH)
+        except OSError as e:
+            logging.getLogger().error("Failed to save session: {}".format(str(e)))
+
+
+    def _clear_session(self):
+        self._user_info = _DEFAULT_USER_INFO.copy()
+        self._session_expires = 0
+        if Config.SESSION_FILE_PATH and os.path.isfile(Config.SESSION_FILE_PATH):
+            try:
+                os.remove(Config.SESSION_FILE_PATH)
+            except OSError as e:
+                logging.getLogger().error("Failed to remove saved session: {}".format(str(e)))
+
+
+    def _refresh_user_info(self, user_info):
+        # updates our premium status and enabled endpoints from a response, so they stay current without logging in again
+        current = self._user_info
+        if not isinstance(user_info, dict) or not current['session']:
+            return
+        updated = dict(current)
+        updated.update((k, v) for k, v in user_info.items() if k in _REFRESHED_USER_INFO_KEYS)
+        if updated == current or self._user_info is not current:
+            # nothing changed (or the session was cleared while we were making the request)
+            return
+        self._user_info = updated
+        self._save_session(self._email_hash)
 
 
     def status(self):
         result = self._make_request("status")
+        self._refresh_user_info(result.get('userInfo'))
         return result
 
 
@@ -163,11 +665,22 @@ class AppAPI:
         return self._make_request("addon", name)
 
 
-    def auctiondb(self, type, realm_id):
+    def auctiondb(self, type, realm_id, dst=None):
+        if dst:
+            # returns whether the data was sent in the compact format (and should be stored raw)
+            return not isinstance(self._make_request("auctiondb", type, realm_id, dst=dst, accept=_RAW_DATA_ACCEPT), dict)
         return self._make_request("auctiondb", type, realm_id)
 
 
-    def shopping(self, realm_id):
+    def auctiondb_patch(self, type, realm_id, last_modified):
+        # gets a patch from the version of the data with the specified last modified time to the latest one
+        return self._make_request("auctiondb_patch", type, realm_id, str(last_modified))
+
+
+    def shopping(self, realm_id, dst=None):
+        if dst:
+            # returns whether the data was sent in the compact format (and should be stored raw)
+            return not isinstance(self._make_request("shopping", realm_id, dst=dst, accept=_RAW_DATA_ACCEPT), dict)
         return self._make_request("shopping", realm_id)
 
 
@@ -175,48 +688,151 @@ class AppAPI:
         self._make_request("log", "crash" if is_crash else "user", data=data)
 
 
-    def black_market(self, region, realm, data, update_time):
-        realm = b64encode(realm.encode("utf8")).decode("ascii")
+    def _encode_upload_args(self, endpoint, args):
+        return [x if i == 0 and endpoint in _REGION_ENDPOINTS else b64encode(x.encode("utf8")).decode("ascii") for i, x in enumerate(args)]
+
+
+    def upload_batch(self, uploads):
+        # `uploads` is a list of (endpoint, args, data, update_time) tuples where the endpoint is one of the upload methods
+        # below (black_market, wow_token, sales, groups or analytics) and `args` are the arguments which come before the
+        # data for that method - returns a list of (uploaded, error) tuples in the same order as `uploads`
+        if not self.has_endpoint("batch"):
+            # the server doesn't support batching, so make the individual requests instead
+            return self.run_concurrently([(getattr(self, endpoint),) + tuple(args) + (data, update_time) for endpoint, args, data, update_time in uploads])
+        results = [(False, None)] * len(uploads)
+        items = []
+        pending = []
+        separate = []
+        for i, (endpoint, args, data, update_time) in enumerate(uploads):
+            if endpoint == "sales" and len(list(split_sales(data, Config.SALES_UPLOAD_MAX_ROWS, Config.SALES_UPLOAD_MAX_BYTES))) > 1:
+                # this is too much to include in the batch, so it's uploaded separately in chunks
+                separate.append(i)
+                continue
+            elif endpoint == "groups" and self._can_diff_groups(self._encode_upload_args(endpoint, args)):
+                # only the changes will be uploaded, which is done separately
+                separate.append(i)
+                continue
+            args = self._encode_upload_args(endpoint, args)
+            watermark_key = [self._user_info['userId']] + args
+            content_hash = None
+            request_endpoint = endpoint
+            if endpoint == "sales":
+                # sales data only contains what's new, so it's always uploaded
+                if self.has_endpoint("sales_compact"):
+                    request_endpoint = "sales_compact"
+                    data = encode_sales(data)
+            else:
+                content_hash = get_content_hash(data)
+                if self._watermarks.is_current(endpoint, watermark_key, update_time, content_hash):
+                    continue
+            items.append({'endpoint': request_endpoint, 'args': args, 'updateTime': update_time, 'data': data})
+            pending.append((i, endpoint, watermark_key, update_time, content_hash))
+        if items:
+            # the server checks the update time of each item against what it has and returns a result for each one
+            try:
+                item_results = self._make_request("batch", data=items)['results']
+                if len(item_results) != len(items):
+                    logging.getLogger().error("Got {} batch results for {} items".format(len(item_results), len(items)))
+                    raise ApiTransientError()
+            except (ApiError, ApiTransientError) as e:
+                for i, _, _, _, _ in pending:
+                    results[i] = (None, e)
+                item_results = []
+            for (i, endpoint, watermark_key, update_time, content_hash), result in zip(pending, item_results):
+                if result.get('error'):
+                    results[i] = (None, ApiError(result['error']))
+                else:
+                    self._watermarks.set(endpoint, watermark_key, update_time, content_hash)
+                    if endpoint == "groups":
+                        self._group_snapshots.put(self._get_group_snapshot_key(watermark_key[1:]), uploads[i][2])
+                    results[i] = (result.get('uploaded', False), None)
+        separate_results = self.run_concurrently([(getattr(self, uploads[i][0]),) + tuple(uploads[i][1]) + (uploads[i][2], uploads[i][3]) for i in separate])
+        for i, result in zip(separate, separate_results):
+            results[i] = result
+        return results
+
+
+    def _upload_if_newer(self, endpoint, args, last_upload_key, data, update_time, upload=None):
+        # `upload` is an optional function which is called with the args and data to do the upload
+        # if we've already uploaded exactly this data, we don't need to ask the server about it again
+        watermark_key = [self._user_info['userId']] + list(args)
+        content_hash = get_content_hash(data)
+        if self._watermarks.is_current(endpoint, watermark_key, update_time, content_hash):
+            return False
         # first, get the last upload time
-        last_upload = self._make_request("black_market", region, realm)['lastUpload']
+        last_upload = self._make_request(endpoint, *args)[last_upload_key]
+        uploaded = False
         if update_time > last_upload:
             # this data is newer than what's on the server, so upload it
-            self._make_request("black_market", region, realm, data=data)
-            return True
-        return False
+            if upload:
+                upload(args, data)
+            else:
+                self._make_request(endpoint, *args, data=data)
+            uploaded = True
+        self._watermarks.set(endpoint, watermark_key, update_time, content_hash)
+        return uploaded
+
+
+    def black_market(self, region, realm, data, update_time):
+        realm = b64encode(realm.encode("utf8")).decode("ascii")
+        return self._upload_if_newer("black_market", [region, realm], 'lastUpload', data, update_time)
 
 
     def wow_token(self, region, data, update_time):
-        # first, get the last update time
-        last_update = self._make_request("wow_token", region)['lastUpdate']
-        if update_time > last_update:
-            # this data is newer than what's on the server, so upload it
-            self._make_request("wow_token", region, data=data)
-            return True
-        return False
+        return self._upload_if_newer("wow_token", [region], 'lastUpdate', data, update_time)
 
 
-    def sales(self, region, realm, account, data=None):
+    def sales(self, region, realm, account, data=None, update_time=None):
         realm = b64encode(realm.encode("utf8")).decode("ascii")
         account = b64encode(account.encode("utf8")).decode("ascii")
+        watermark_key = [self._user_info['userId'], region, realm, account]
         if data:
-            # upload the data
-            self._make_request("sales", region, realm, account, data=data)
+            # upload the data in chunks (oldest first) so we don't lose our progress if one of them fails
+            for chunk in split_sales(data, Config.SALES_UPLOAD_MAX_ROWS, Config.SALES_UPLOAD_MAX_BYTES):
+                # use the compact format if the server supports it
+                if self.has_endpoint("sales_compact"):
+                    self._make_request("sales_compact", region, realm, account, data=encode_sales(chunk))
+                else:
+                    self._make_request("sales", region, realm, account, data=chunk)
+                self._watermarks.set("sales", watermark_key, max(x[5] for x in chunk))
+            if update_time:
+                self._watermarks.set("sales", watermark_key, update_time)
+            return True
         else:
-            # get the last upload time
-            return self._make_request("sales", region, realm, account)['lastUpload']
+            # get the last upload time (which we'll know locally unless it's time to check with the server again)
+            last_upload = self._watermarks.get("sales", watermark_key)
+            if last_upload is None:
+                last_upload = self._make_request("sales", region, realm, account)['lastUpload']
+                self._watermarks.set("sales", watermark_key, last_upload)
+            return last_upload
 
 
     def groups(self, account, profile, data, update_time):
         account = b64encode(account.encode("utf8")).decode("ascii")
         profile = b64encode(profile.encode("utf8")).decode("ascii")
-        # first, get the last upload time
-        last_upload = self._make_request("groups", account, profile)['lastUpload']
-        if update_time > last_upload:
-            # this data is newer than what's on the server, so upload it
-            self._make_request("groups", account, profile, data=data)
-            return True
-        return False
+        return self._upload_if_newer("groups", [account, profile], 'lastUpload', data, update_time, self._upload_groups)
+
+
+    def _get_group_snapshot_key(self, args):
+        return "/".join([str(self._user_info['userId'])] + args)
+
+
+    def _can_diff_groups(self, args):
+        return self.has_endpoint("groups_diff") and self._group_snapshots.get(self._get_group_snapshot_key(args)) is not None
+
+
+    def _upload_groups(self, args, data):
+        # if we have what we last uploaded, just send what changed since then
+        snapshot_key = self._get_group_snapshot_key(args)
+        snapshot = self._group_snapshots.get(snapshot_key)
+        if snapshot and self.has_endpoint("groups_diff"):
+            if not self._make_request("groups_diff", *args, data=get_groups_diff(snapshot, data))['applied']:
+                # the server's copy doesn't match our snapshot, so upload everything
+                logging.getLogger().info("Server couldn't apply group diff, so uploading everything")
+                self._make_request("groups", *args, data=data)
+        else:
+            self._make_request("groups", *args, data=data)
+        self._group_snapshots.put(snapshot_key, data)
 
 
     def app(self, path=None):
@@ -227,21 +843,35 @@ class AppAPI:
             return self._make_request("app", "win" if Config.IS_WINDOWS else "mac")
 
 
-    def backup(self, name=None, data=None):
+    def backup(self, name=None, data=None, dst=None):
         if name and data:
             return self._make_request("backup", b64encode(name.encode("ascii")).decode("ascii"), data=data)
         elif name:
-            return self._make_request("backup", b64encode(name.encode("ascii")).decode("ascii"))
+            return self._make_request("backup", b64encode(name.encode("ascii")).decode("ascii"), dst=dst)
         else:
             return self._make_request("backup")['data']
 
 
+    def backup_chunks(self, hashes):
+        # returns the hashes of the chunks which the server doesn't yet have
+        return self._make_request("backup_chunks", data=hashes)['missing']
+
+
+    def backup_chunk(self, chunk_hash, data=None):
+        if data:
+            self._make_request("backup_chunk", chunk_hash, data=data)
+        else:
+            return self._make_request("backup_chunk", chunk_hash)
+
+
+    def backup_manifest(self, name, manifest=None):
+        name = b64encode(name.encode("ascii")).decode("ascii")
+        if manifest:
+            self._make_request("backup_manifest", name, data=manifest)
+        else:
+            return self._make_request("backup_manifest", name)
+
+
     def analytics(self, account, data, update_time):
         account = b64encode(account.encode("utf8")).decode("ascii")
-        # first, get the last update time
-        last_update = self._make_request("analytics", account)['lastUpload']
-        if update_time > last_update:
-            # this data is newer than what's on the server, so upload it
-            self._make_request("analytics", account, data=data)
-            return True
-        return False
+        return self._upload_if_newer("analytics", [account], 'lastUpload', data, update_time)
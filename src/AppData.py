@@ -14,37 +14,176 @@
 # along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# General python modules
+from hashlib import md5
+import logging
+import mmap
+import os
+import re
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+import threading
+
+
+_COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class AppDataPayload:
+    # a payload which is streamed into a temporary file (i.e. straight from a download) rather than kept in memory - if
+    # `store_raw` is set before it's finished, the data is stored as-is rather than as a string which returns it
+    def __init__(self):
+        self._file = TemporaryFile()
+        self._raw_md5 = md5()
+        self._md5 = md5(b"[[return ")
+        self.store_raw = False
+        self.length = 0
+        self.key = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.close()
+        else:
+            self.finish()
+
+
+    def write(self, data):
+        self._file.write(data)
+        self._raw_md5.update(data)
+        self._md5.update(data)
+        self.length += len(data)
+
+
+    def finish(self):
+        if self.store_raw:
+            self.key = self._raw_md5.hexdigest()
+        else:
+            self._md5.update(b"]]")
+            self.key = self._md5.hexdigest()
+
+
+    def copy_to(self, dst):
+        self._file.seek(0)
+        if self.store_raw:
+            copyfileobj(self._file, dst)
+            return self.length
+        dst.write(b"[[return ")
+        copyfileobj(self._file, dst)
+        dst.write(b"]]")
+        return self.length + len(b"[[return ]]")
+
+
+    def close(self):
+        self._file.close()
+
+
+    def is_closed(self):
+        return self._file.closed
+
+
 class AppData:
     TYPES = ["AUCTIONDB_MARKET_DATA", "SHOPPING_SEARCHES", "APP_INFO"]
+    # the data for these types is often identical for multiple (connected) realms, so each distinct payload is stored
+    # once in a shared table which the realms' LoadData() calls reference
+    SHARED_TYPES = ["AUCTIONDB_MARKET_DATA", "SHOPPING_SEARCHES"]
+    _SHARED_TYPE = "SHARED"
+    _SHARED_HEADER = "local _SHARED = {}\n"
+    _SHARED_REF_RE = re.compile(br'_SHARED\["([0-9a-f]+)"\]\)$')
 
 
     def __init__(self, path):
         self._path = path
-        self._info = []
+        # payloads may be downloaded (and patches applied) on other threads while we save
+        self._lock = threading.RLock()
+        self._payloads = []
         self._modified = False
+        self._load()
+
+
+    def _load(self):
+        # only the trailing "--<type,realm,time>" comments are parsed here - the (large) data of each entry is just
+        # indexed by its offset in the file and loaded when it's actually needed
+        self._info = []
+        self._index = {}
+        self._shared = {}
+        self._mtime = None
+        self._size = None
         try:
-            with open(self._path, encoding="utf8") as app_data_file:
+            with open(self._path, "rb") as app_data_file:
+                self._mtime, self._size = self._get_version(app_data_file)
+                offset = 0
                 for line in app_data_file:
-                    line = line.strip()
-                    data = line[:line.rfind("--")-1]
+                    line_offset = offset
+                    offset += len(line)
+                    line = line.rstrip()
+                    start = len(line) - len(line.lstrip())
+                    trailer_index = line.rfind(b"--")
+                    if trailer_index < 0:
+                        continue
                     try:
-                        type, realm, time = line[line.rfind("--")+3:-1].split(",")
-                    except ValueError:
+                        type, realm, time = line[trailer_index+3:-1].decode("utf8").split(",")
+                    except (UnicodeDecodeError, ValueError):
                         continue
-                    if type in self.TYPES:
+                    info = {'data': None, 'offset': line_offset + start, 'length': trailer_index - 1 - start, 'type': type, 'realm': realm, 'time': int(time)}
+                    if type == self._SHARED_TYPE:
+                        self._shared[realm] = info
+                    elif type in self.TYPES:
                         # remove old auctiondb global data
                         if type == "AUCTIONDB_MARKET_DATA" and realm == "Global":
                             continue
-                        self._info.append({'data': data, 'type': type, 'realm': realm, 'time': int(time)})
+                        # check if this entry references a shared payload
+                        match = self._SHARED_REF_RE.search(line[max(start, trailer_index - 65):trailer_index - 1])
+                        info['shared'] = match.group(1).decode("ascii") if match else None
+                        self._info.append(info)
+                        self._index[(type, realm)] = info
         except:
             pass
 
 
+    def _reload(self):
+        # the file was replaced since we loaded it (i.e. the addon was reinstalled), so the entries we haven't changed
+        # can't be copied from it anymore - reload it and put our changes on top
+        logging.getLogger().warning("AppData.lua changed since it was loaded, so reloading it")
+        changed = [info for info in self._info if info['data'] is not None]
+        changed_shared = {key: info for key, info in self._shared.items() if info['data'] is not None}
+        self._load()
+        self._shared.update(changed_shared)
+        for info in changed:
+            if info['shared'] and info['shared'] not in self._shared:
+                # the data this references went away with the old file
+                continue
+            old_info = self._get_info(info['type'], info['realm'])
+            if old_info:
+                self._info[self._info.index(old_info)] = info
+            else:
+                self._info.append(info)
+            self._index[(info['type'], info['realm'])] = info
+
+
+    def _get_version(self, app_data_file):
+        stat = os.fstat(app_data_file.fileno())
+        return stat.st_mtime, stat.st_size
+
+
+    def get_path(self):
+        return self._path
+
+
+    def is_stale(self):
+        # returns whether the file has changed since we loaded (or last saved) it
+        try:
+            with open(self._path, "rb") as app_data_file:
+                return self._get_version(app_data_file) != (self._mtime, self._size)
+        except OSError:
+            return self._mtime is not None
+
+
     def _get_info(self, type, realm):
-        for info in self._info:
-            if info['type'] == type and info['realm'] == realm:
-                return info
-        return None
+        return self._index.get((type, realm), None)
 
 
     def last_update(self, type, realm):
@@ -55,6 +194,17 @@ class AppData:
         return info['time']
 
 
+    def get_size(self, type, realm):
+        # returns the size of the data saved for this entry (or 0 if we don't know it)
+        assert(type in self.TYPES)
+        info = self._get_info(type, realm)
+        if not info:
+            return 0
+        if info.get('shared') and info['shared'] in self._shared:
+            info = self._shared[info['shared']]
+        return info.get('length', 0) if info['data'] is None else 0
+
+
     def update(self, type, realm, data, time, store_raw=False):
         self._modified = True
         assert(type in self.TYPES)
@@ -62,16 +212,180 @@ class AppData:
         if not info:
             info = {'data': None, 'type': type, 'realm': realm, 'time': 0}
             self._info.append(info)
+            self._index[(type, realm)] = info
+        info['time'] = time
+        value = data if store_raw else "[[return {}]]".format(data)
+        if type in self.SHARED_TYPES:
+            key = md5(value.encode("utf8")).hexdigest()
+            if key not in self._shared:
+                self._shared[key] = {'data': "_SHARED[\"{}\"]={}".format(key, value), 'type': self._SHARED_TYPE, 'realm': key, 'time': 0}
+            info['shared'] = key
+            value = "_SHARED[\"{}\"]".format(key)
+        else:
+            info['shared'] = None
+        info['data'] = 'select(2, ...).LoadData("{}","{}",{})'.format(type, realm, value)
+
+
+    def new_payload(self):
+        payload = AppDataPayload()
+        with self._lock:
+            self._payloads.append(payload)
+        return payload
+
+
+    def update_from_payload(self, type, realm, payload, time):
+        # same as update(), but with the data coming from a finished payload returned by new_payload()
+        self._modified = True
+        assert(type in self.TYPES and payload.key)
+        info = self._get_info(type, realm)
+        if not info:
+            info = {'data': None, 'type': type, 'realm': realm, 'time': 0}
+            self._info.append(info)
+            self._index[(type, realm)] = info
         info['time'] = time
-        if store_raw:
-            info['data'] = 'select(2, ...).LoadData("{}","{}",{})'.format(type, realm, data)
+        if type in self.SHARED_TYPES:
+            if payload.key not in self._shared:
+                self._shared[payload.key] = {'data': ["_SHARED[\"{}\"]=".format(payload.key), payload], 'type': self._SHARED_TYPE, 'realm': payload.key, 'time': 0}
+            info['shared'] = payload.key
+            info['data'] = 'select(2, ...).LoadData("{}","{}",_SHARED["{}"])'.format(type, realm, payload.key)
         else:
-            info['data'] = 'select(2, ...).LoadData("{}","{}",[[return {}]])'.format(type, realm, data)
+            info['shared'] = None
+            info['data'] = ['select(2, ...).LoadData("{}","{}",'.format(type, realm), payload, ")"]
+
+
+    def _get_data_range(self, type, realm):
+        # returns the (offset, length, store_raw) of the value stored for this entry within the file if possible
+        info = self._get_info(type, realm)
+        if not info or not info.get('shared') or info['shared'] not in self._shared:
+            return None
+        shared_info = self._shared[info['shared']]
+        if shared_info['data'] is not None:
+            # this data hasn't been saved yet
+            return None
+        prefix = "_SHARED[\"{}\"]=".format(info['shared']).encode("utf8")
+        offset = shared_info['offset'] + len(prefix)
+        length = shared_info['length'] - len(prefix)
+        with open(self._path, "rb") as app_data_file:
+            app_data_file.seek(shared_info['offset'])
+            is_wrapped = app_data_file.read(len(prefix) + len(b"[[return ")) == prefix + b"[[return "
+            app_data_file.seek(shared_info['offset'] + shared_info['length'] - len(b"]]"))
+            is_wrapped = is_wrapped and app_data_file.read(len(b"]]")) == b"]]"
+        if is_wrapped:
+            return offset + len(b"[[return "), length - len(b"[[return ]]"), False
+        return offset, length, True
 
 
-    def save(self):
+    def apply_patch(self, type, realm, ops, checksum):
+        # builds a new payload by applying a patch to the data currently stored for this entry - the patch `ops` are
+        # either [offset, length] lists to copy from the current data or strings to insert and `checksum` is the md5 of
+        # the resulting data - returns None if the patch can't be applied
+        with self._lock:
+            return self._apply_patch(type, realm, ops, checksum)
+
+
+    def _apply_patch(self, type, realm, ops, checksum):
+        data_range = self._get_data_range(type, realm)
+        if not data_range:
+            return None
+        base_offset, base_length, store_raw = data_range
+        payload = self.new_payload()
+        payload.store_raw = store_raw
+        data_md5 = md5()
+        try:
+            with open(self._path, "rb") as app_data_file:
+                for op in ops:
+                    if isinstance(op, str):
+                        data = op.encode("utf8")
+                        payload.write(data)
+                        data_md5.update(data)
+                        continue
+                    offset, length = op
+                    if offset < 0 or length < 0 or offset + length > base_length:
+                        raise ValueError("Invalid patch range")
+                    app_data_file.seek(base_offset + offset)
+                    while length > 0:
+                        data = app_data_file.read(min(length, _COPY_BLOCK_SIZE))
+                        if not data:
+                            raise ValueError("Unexpected end of file")
+                        payload.write(data)
+                        data_md5.update(data)
+                        length -= len(data)
+        except (OSError, TypeError, ValueError) as e:
+            logging.getLogger().error("Failed to apply patch ({}, {}): {}".format(type, realm, str(e)))
+            payload.close()
+            return None
+        if data_md5.hexdigest() != checksum:
+            logging.getLogger().error("Patched data doesn't match the checksum ({}, {})".format(type, realm))
+            payload.close()
+            return None
+        payload.finish()
+        return payload
+
+
+    def _write_data(self, app_data_file, info, src_map):
+        if info['data'] is None:
+            return app_data_file.write(memoryview(src_map)[info['offset']:info['offset']+info['length']])
+        elif isinstance(info['data'], str):
+            return app_data_file.write(info['data'].encode("utf8"))
+        length = 0
+        for part in info['data']:
+            if isinstance(part, AppDataPayload):
+                length += part.copy_to(app_data_file)
+            else:
+                length += app_data_file.write(part.encode("utf8"))
+        return length
+
+
+    def save(self, close_payloads=True):
+        # if `close_payloads` is False, only the payloads which were saved are closed (so others can still be written)
+        with self._lock:
+            self._save(close_payloads)
+
+
+    def _save(self, close_payloads):
         if not self._modified:
             return
-        with open(self._path, 'w', encoding="utf8") as app_data_file:
-            for info in self._info:
-                app_data_file.write("{} --<{},{},{}>\n".format(info['data'], info['type'], info['realm'], info['time']))
+        if self.is_stale():
+            self._reload()
+        # the shared payloads need to come before the entries which reference them (unreferenced ones are dropped)
+        shared_keys = set(info['shared'] for info in self._info if info['shared'])
+        self._shared = {key: info for key, info in self._shared.items() if key in shared_keys}
+        infos = list(self._shared.values()) + self._info
+        # write to a temporary file which then replaces the existing one so a crash can't leave it truncated
+        temp_path = self._path + ".tmp"
+        src_map = None
+        layout = []
+        try:
+            if any(info['data'] is None for info in infos):
+                # copy the data we haven't changed straight from the existing file
+                with open(self._path, "rb") as src_file:
+                    if self._get_version(src_file) != (self._mtime, self._size):
+                        # it was replaced again since we checked, so the offsets we'd copy from aren't valid
+                        raise OSError("AppData.lua changed while saving")
+                    src_map = mmap.mmap(src_file.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(temp_path, "wb") as app_data_file:
+                offset = 0
+                if self._shared:
+                    offset += app_data_file.write(self._SHARED_HEADER.encode("utf8"))
+                for info in infos:
+                    length = self._write_data(app_data_file, info, src_map)
+                    layout.append((offset, length))
+                    offset += length
+                    offset += app_data_file.write(" --<{},{},{}>\n".format(info['type'], info['realm'], info['time']).encode("utf8"))
+        finally:
+            if src_map:
+                src_map.close()
+        os.replace(temp_path, self._path)
+        saved_payloads = set(part for info in infos if isinstance(info['data'], list) for part in info['data'] if isinstance(part, AppDataPayload))
+        for payload in self._payloads:
+            if close_payloads or payload in saved_payloads:
+                payload.close()
+        self._payloads = [x for x in self._payloads if not x.is_closed()]
+        # the data now lives in the new file
+        for info, (offset, length) in zip(infos, layout):
+            info['data'] = None
+            info['offset'] = offset
+            info['length'] = length
+        self._modified = False
+        with open(self._path, "rb") as app_data_file:
+            self._mtime, self._size = self._get_version(app_data_file)
@@ -0,0 +1,84 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+from time import time
+
+
+class BackupRetention:
+    """
+    Decides which backups to purge given:
+     - `tiers`: a list of (max_age, interval) tuples sorted by max_age - within each tier, only the most recent backup
+       of every `interval` seconds is kept (0 keeps all of them and a max_age of None matches any older backup)
+     - `max_age`: backups older than this are always purged
+     - `max_size`: the total size in bytes of the backup folder, counting every file in it
+    Backups which are flagged to be kept on the server, the latest backup of every account and backups which are
+    protected by the caller are never purged, so the folder only exceeds `max_size` if they alone don't fit in it.
+    """
+    def __init__(self, tiers, max_age, max_size):
+        self._tiers = tiers
+        self._max_age = max_age
+        self._max_size = max_size
+
+
+    def _get_interval(self, age):
+        for tier_age, interval in self._tiers:
+            if tier_age is None or age < tier_age:
+                return interval
+        return None
+
+
+    def get_purgeable(self, backups, sizes, other_size=0, protected=(), now=None):
+        # `sizes` is a lookup table of local zip name -> size in bytes (of the zip and any files which go with it),
+        # `other_size` is the size of everything else in the folder and `protected` is a list of local zip names which
+        # can't be purged right now (i.e. ones which still need to be uploaded)
+        now = now or time()
+        purged = []
+        retained = []
+        newest = []
+        for account in set(x.account for x in backups):
+            account_backups = sorted([x for x in backups if x.account == account], key=lambda x: x.timestamp, reverse=True)
+            newest.append(account_backups[0])
+            seen_buckets = set()
+            for backup in account_backups:
+                if backup.keep or backup.get_local_zip_name() in protected:
+                    retained.append(backup)
+                    continue
+                timestamp = backup.timestamp.timestamp()
+                age = now - timestamp
+                interval = self._get_interval(age)
+                if age > self._max_age or interval is None:
+                    purged.append(backup)
+                elif interval:
+                    # only keep the most recent backup within each interval
+                    bucket = (interval, int(timestamp // interval))
+                    if bucket in seen_buckets:
+                        purged.append(backup)
+                    else:
+                        seen_buckets.add(bucket)
+                        retained.append(backup)
+                else:
+                    retained.append(backup)
+
+        # purge the oldest backups until we're within the size budget (but keep the latest one for every account)
+        total_size = other_size + sum(sizes.get(x.get_local_zip_name(), 0) for x in retained)
+        candidates = sorted([x for x in retained if not x.keep and x.get_local_zip_name() not in protected and x not in newest], key=lambda x: x.timestamp)
+        for backup in candidates:
+            if total_size <= self._max_size:
+                break
+            total_size -= sizes.get(backup.get_local_zip_name(), 0)
+            purged.append(backup)
+        return purged
@@ -0,0 +1,283 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from AppAPI import ApiError, ApiSessionError, ApiTransientError
+import Config
+
+# General python modules
+from hashlib import sha256
+import json
+import logging
+from lzma import LZMAError
+import os
+import random
+import sys
+import tempfile
+from zipfile import BadZipFile, ZipFile, ZIP_STORED
+import zlib
+
+
+# chunk boundaries are content-defined (using a gear hash) so an insertion only changes the chunks around it
+_MIN_CHUNK_SIZE = 2 * 1024
+_MAX_CHUNK_SIZE = 64 * 1024
+_CHUNK_MASK = (1 << 13) - 1 # ~8KB average chunk size
+_READ_SIZE = 1024 * 1024
+# only the low bits of the hash are checked, and those only depend on the low bits of the gear values
+_GEAR = [random.Random(i).getrandbits(32) & _CHUNK_MASK for i in range(256)]
+# manifests list the chunks of the uncompressed contents of each file in the backup
+_MANIFEST_VERSION = 2
+
+
+def iter_chunks(f):
+    # yields the content-defined chunks of the file object `f` without reading it all into memory
+    buffer = b""
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < _MAX_CHUNK_SIZE:
+            data = f.read(_READ_SIZE)
+            if data:
+                buffer = buffer[start:] + data
+                start = 0
+                continue
+            eof = True
+        if start == len(buffer):
+            return
+        end = min(len(buffer), start + _MAX_CHUNK_SIZE)
+        h = 0
+        cut = end
+        for i in range(start + _MIN_CHUNK_SIZE, end):
+            h = ((h << 1) + _GEAR[buffer[i]]) & _CHUNK_MASK
+            if not h:
+                cut = i + 1
+                break
+        yield buffer[start:cut]
+        start = cut
+
+
+def get_chunk_hash(chunk):
+    return sha256(chunk).hexdigest()
+
+
+def get_chunk_index_path(zip_path):
+    # the manifest of each local backup we've uploaded is saved next to it so its chunks can be reused later
+    return zip_path + Config.BACKUP_CHUNK_INDEX_SUFFIX
+
+
+def _write_zip_file(zip_file, name, chunks):
+    # writes the chunks to a new file in the zip one at a time (rather than holding the whole file in memory)
+    if sys.version_info >= (3, 6):
+        with zip_file.open(name, "w") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return
+    # older versions can only add a file to a zip from the file system
+    fd, temp_path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        zip_file.write(temp_path, name)
+    finally:
+        os.remove(temp_path)
+
+
+class _LocalChunkReader:
+    # reads chunks from the files in local backups - the current file is kept open so chunks which are read in order
+    # don't need it to be decompressed again (files within a zip can only be read forwards, so going back means starting
+    # over) and only one is open at a time since each holds a decompression buffer of up to several MB
+    def __init__(self):
+        self._zips = {}
+        self._file = None
+        self._file_key = None
+        self._pos = 0
+        self._failed = set()
+
+
+    def _close_file(self):
+        if self._file:
+            self._file.close()
+        self._file = None
+        self._file_key = None
+
+
+    def read(self, path, file_name, offset, length):
+        # returns None if the chunk couldn't be read
+        if path in self._failed:
+            return None
+        try:
+            if self._file_key != (path, file_name) or offset < self._pos:
+                self._close_file()
+                if path not in self._zips:
+                    self._zips[path] = ZipFile(path)
+                self._file = self._zips[path].open(file_name)
+                self._file_key = (path, file_name)
+                self._pos = 0
+            while self._pos < offset:
+                skipped = len(self._file.read(min(offset - self._pos, _READ_SIZE)))
+                if not skipped:
+                    break
+                self._pos += skipped
+            chunk = self._file.read(length)
+            self._pos += len(chunk)
+            return chunk
+        except (OSError, EOFError, KeyError, BadZipFile, LZMAError, zlib.error) as e:
+            logging.getLogger().error("Failed to read local backup ({}): {}".format(path, str(e)))
+            self._close_file()
+            self._failed.add(path)
+            return None
+
+
+    def close(self):
+        self._close_file()
+        for zip_file in self._zips.values():
+            zip_file.close()
+        self._zips = {}
+
+
+class BackupSync:
+    """
+    Syncs backups with the server as deduplicated chunks. The uncompressed contents of each file in a backup zip are split
+    into content-defined chunks, so a small change to a file only changes the chunks around it and unchanged files are
+    never uploaded again. The manifest lists the (hash, length) of the chunks of each file, and chunks are sent compressed.
+    """
+    def __init__(self, api):
+        self._api = api
+
+
+    def is_supported(self):
+        return all(self._api.has_endpoint(x) for x in ("backup_chunk", "backup_chunks", "backup_manifest"))
+
+
+    def _load_index(self, zip_path):
+        try:
+            with open(get_chunk_index_path(zip_path), encoding="utf8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.getLogger().error("Failed to load backup chunk index ({}): {}".format(zip_path, str(e)))
+            return None
+
+
+    def _save_index(self, zip_path, manifest):
+        path = get_chunk_index_path(zip_path)
+        try:
+            with open(path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(manifest, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.getLogger().error("Failed to save backup chunk index ({}): {}".format(zip_path, str(e)))
+
+
+    def _load_indexes(self, zip_paths):
+        # returns the saved manifests of the most recent of `zip_paths` (most recent first) which have one
+        indexes = []
+        for path in zip_paths:
+            if len(indexes) >= Config.BACKUP_SYNC_MAX_INDEXES:
+                break
+            index = self._load_index(path)
+            if index and index.get('version') == _MANIFEST_VERSION:
+                indexes.append((path, index))
+        return indexes
+
+
+    def _get_manifest(self, zip_path, previous_paths):
+        # files which are unchanged from one of the previous backups (same name, size and CRC) reuse its chunk list
+        # rather than being chunked again
+        known_files = {}
+        for _, index in reversed(self._load_indexes(previous_paths)):
+            for file_info in index['files']:
+                known_files[(file_info['name'], file_info['size'], file_info['crc'])] = file_info['chunks']
+        files = []
+        with ZipFile(zip_path) as zip_file:
+            for info in zip_file.infolist():
+                chunks = known_files.get((info.filename, info.file_size, info.CRC))
+                if chunks is None:
+                    with zip_file.open(info) as f:
+                        chunks = [[get_chunk_hash(x), len(x)] for x in iter_chunks(f)]
+                files.append({'name': info.filename, 'size': info.file_size, 'crc': info.CRC, 'chunks': chunks})
+        return {'version': _MANIFEST_VERSION, 'files': files, 'size': sum(x['size'] for x in files)}
+
+
+    def upload(self, name, zip_path, previous_paths=None):
+        # `previous_paths` are the other local backups of the account (most recent first)
+        manifest = self._get_manifest(zip_path, previous_paths or [])
+        missing = set(self._api.backup_chunks(list(set(x[0] for f in manifest['files'] for x in f['chunks']))))
+        uploaded = 0
+        if missing:
+            with ZipFile(zip_path) as zip_file:
+                for file_info in manifest['files']:
+                    if not any(x[0] in missing for x in file_info['chunks']):
+                        continue
+                    with zip_file.open(file_info['name']) as f:
+                        for chunk_hash, length in file_info['chunks']:
+                            chunk = f.read(length)
+                            if chunk_hash not in missing:
+                                continue
+                            if get_chunk_hash(chunk) != chunk_hash:
+                                raise OSError("Backup changed while uploading it ({})".format(zip_path))
+                            self._api.backup_chunk(chunk_hash, zlib.compress(chunk))
+                            missing.remove(chunk_hash)
+                            uploaded += length
+        self._api.backup_manifest(name, manifest)
+        self._save_index(zip_path, manifest)
+        logging.getLogger().info("Uploaded {} of {} bytes for backup ({})".format(uploaded, manifest['size'], name))
+
+
+    def download(self, name, dst, local_paths=None):
+        # `local_paths` are local backups of the account (most recent first) which may already have some of the chunks
+        try:
+            manifest = self._api.backup_manifest(name)
+        except ApiSessionError:
+            raise
+        except ApiError as e:
+            # this backup was uploaded as a whole zip (i.e. by an older version of the app), so download it that way
+            logging.getLogger().info("Downloading backup ({}) without a manifest: {}".format(name, str(e)))
+            self._api.backup(name, dst=dst)
+            return
+        # find the chunks we have locally using the saved manifests (so nothing needs to be chunked again)
+        local_chunks = {}
+        for path, index in self._load_indexes(local_paths or []):
+            for file_info in index['files']:
+                offset = 0
+                for chunk_hash, length in file_info['chunks']:
+                    local_chunks.setdefault(chunk_hash, (path, file_info['name'], offset, length))
+                    offset += length
+        local_reader = _LocalChunkReader()
+        downloaded = 0
+        def iter_file_chunks(file_info):
+            nonlocal downloaded
+            for chunk_hash, _ in file_info['chunks']:
+                chunk = local_reader.read(*local_chunks[chunk_hash]) if chunk_hash in local_chunks else None
+                if chunk is None or get_chunk_hash(chunk) != chunk_hash:
+                    try:
+                        chunk = zlib.decompress(self._api.backup_chunk(chunk_hash))
+                    except zlib.error:
+                        raise ApiTransientError("Backup chunk is corrupted")
+                    if get_chunk_hash(chunk) != chunk_hash:
+                        raise ApiTransientError("Backup chunk is corrupted")
+                    downloaded += len(chunk)
+                yield chunk
+        try:
+            # the downloaded zip is only extracted when restoring it, so don't spend time compressing it
+            with ZipFile(dst, "w", ZIP_STORED) as zip_file:
+                for file_info in manifest['files']:
+                    _write_zip_file(zip_file, file_info['name'], iter_file_chunks(file_info))
+        finally:
+            local_reader.close()
+        logging.getLogger().info("Downloaded {} of {} bytes for backup ({})".format(downloaded, manifest['size'], name))
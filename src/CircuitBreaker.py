@@ -0,0 +1,80 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+import logging
+import threading
+from time import time
+
+
+class CircuitBreaker:
+    """
+    Tracks failures for a single endpoint. After `threshold` consecutive failures, the breaker opens and requests are
+    skipped for a cool-off period (which doubles every time it opens again, up to `max_cooloff` seconds). Once the
+    cool-off period is over, a single trial request is allowed through which either closes it again or re-opens it.
+    """
+    def __init__(self, name, threshold, cooloff, max_cooloff):
+        self._name = name
+        self._threshold = threshold
+        self._cooloff = cooloff
+        self._max_cooloff = max_cooloff
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opens = 0
+        self._open_until = 0
+        self._trial_pending = False
+
+
+    def is_open(self):
+        with self._lock:
+            return self._failures >= self._threshold and (time() < self._open_until or self._trial_pending)
+
+
+    def allow_request(self):
+        with self._lock:
+            if self._failures < self._threshold:
+                return True
+            if time() < self._open_until or self._trial_pending:
+                return False
+            # let a trial request through
+            self._trial_pending = True
+            return True
+
+
+    def record_success(self):
+        with self._lock:
+            if self._failures >= self._threshold:
+                logging.getLogger().info("Closing circuit breaker for {}".format(self._name))
+            self._failures = 0
+            self._opens = 0
+            self._trial_pending = False
+
+
+    def release_trial(self):
+        # lets another trial request through if this one ended without a result (i.e. it ran out of time)
+        with self._lock:
+            self._trial_pending = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_pending = False
+            if self._failures >= self._threshold:
+                cooloff = min(self._cooloff * 2 ** self._opens, self._max_cooloff)
+                self._opens += 1
+                self._open_until = time() + cooloff
+                logging.getLogger().warning("Opening circuit breaker for {} for {}s".format(self._name, cooloff))
@@ -35,6 +35,12 @@ CURRENT_VERSION = _version.VERSION
 GIT_COMMIT = _version.COMMIT
 LOG_FILE_PATH = None
 BACKUP_DIR_PATH = None
+HTTP_CACHE_DIR_PATH = None
+UPLOAD_WATERMARKS_PATH = None
+GROUP_SNAPSHOT_DIR_PATH = None
+UPLOAD_QUEUE_DIR_PATH = None
+SESSION_FILE_PATH = None
+ADDON_CACHE_DIR_PATH = None
 STATUS_CHECK_INTERVAL_S = 10 * 60
 BACKUP_TIME_FORMAT = "%Y%m%d%H%M%S"
 BACKUP_NAME_SEPARATOR = "_"
@@ -43,6 +49,80 @@ UPDATER_PATH = os.path.join("updater", "TSMUpdater.exe") if IS_WINDOWS else os.p
 NEW_APP_PATH = os.path.join("app_new", "TSMApplication.exe") if IS_WINDOWS else os.path.join("app_new", "TSMApplication")
 SETTINGS_VERSION = 2
 TEMP_BACKUP_DIR = "TempBackups"
+# backup retention tiers as (max age, thinning interval) - an interval of 0 keeps every backup and a max age of None
+# applies to all older backups (which are still subject to the 'backup_expire' setting)
+BACKUP_RETENTION_TIERS = [(24 * 60 * 60, 0), (30 * 24 * 60 * 60, 24 * 60 * 60), (None, 7 * 24 * 60 * 60)]
+BACKUP_MAX_DIR_SIZE = 500 * 1024 * 1024
+# the chunk list of each uploaded backup is saved next to it (so it never needs to be chunked again) and the ones of the
+# most recent few backups of an account are used to find the chunks which don't need to be uploaded / downloaded
+BACKUP_CHUNK_INDEX_SUFFIX = ".chunks.json"
+BACKUP_SYNC_MAX_INDEXES = 3
+HTTP_CONNECT_TIMEOUT_S = 10
+HTTP_READ_TIMEOUT_S = 30
+# (connect, read) timeouts for endpoints which shouldn't use the defaults above
+API_ENDPOINT_TIMEOUTS = {
+    'login': (5, 15),
+    'status': (5, 15),
+    'auctiondb': (10, 120),
+    'auctiondb_patch': (10, 60),
+    'shopping': (10, 120),
+    'addon': (10, 60),
+    'app': (10, 120),
+    'backup': (10, 120),
+    'backup_chunk': (10, 60),
+    'batch': (10, 60),
+}
+# small GETs which get a second (hedged) request sent if they take longer than the given percentile of recent requests
+API_HEDGED_ENDPOINTS = ["status", "black_market", "wow_token", "sales", "groups", "analytics"]
+API_HEDGE_PERCENTILE = 0.95
+API_HEDGE_MIN_SAMPLES = 20
+API_HEDGE_DEFAULT_DELAY_S = 2
+API_LATENCY_SAMPLES = 100
+# all the requests for a sync cycle must be done within this time
+SYNC_CYCLE_DEADLINE_S = 8 * 60
+# how long we keep using a session if the server doesn't tell us when it expires
+SESSION_MAX_AGE_S = 12 * 60 * 60
+HTTP_IDLE_TIMEOUT_S = 60
+DNS_CACHE_TTL_S = 5 * 60
+API_MAX_WORKERS = 8
+API_MAX_REQUESTS_PER_HOST = 4
+HTTP_CACHE_ENDPOINTS = ["status", "backup", "app"]
+HTTP_CACHE_MAX_SIZE = 50 * 1024 * 1024
+# addon packages are cached by version (see AddonCache)
+ADDON_CACHE_MAX_SIZE = 100 * 1024 * 1024
+# how often we check the last upload times with the server even if our local data hasn't changed
+UPLOAD_RECONCILE_INTERVAL_S = 6 * 60 * 60
+# large sales histories are uploaded in chunks of (roughly) at most this many rows / bytes of JSON
+SALES_UPLOAD_MAX_ROWS = 20000
+SALES_UPLOAD_MAX_BYTES = 1024 * 1024
+# uploads which fail are queued and retried with exponential backoff, a limited number at a time
+UPLOAD_QUEUE_MIN_RETRY_S = 60
+UPLOAD_QUEUE_MAX_RETRY_S = 6 * 60 * 60
+UPLOAD_QUEUE_MAX_REPLAY = 20
+# requests which can be retried are retried with exponential backoff (with jitter)
+API_MAX_RETRIES = 2
+API_RETRY_BASE_DELAY_S = 1
+API_RETRY_MAX_DELAY_S = 10
+# after this many consecutive failures, requests to an endpoint are skipped for a (doubling) cool-off period
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_COOLOFF_S = 2 * 60
+CIRCUIT_BREAKER_MAX_COOLOFF_S = 30 * 60
+# login attempts which fail because we can't reach the server are retried with exponential backoff (with jitter)
+LOGIN_RETRY_BASE_DELAY_S = 30
+LOGIN_RETRY_MAX_DELAY_S = 30 * 60
+# bulk transfers (uploads and large downloads) are limited to these rates in bytes per second (None for no limit), with
+# lower limits while WoW is running so they don't hurt the game's latency
+UPLOAD_RATE_LIMIT_BPS = None
+DOWNLOAD_RATE_LIMIT_BPS = None
+WOW_RUNNING_UPLOAD_RATE_LIMIT_BPS = 64 * 1024
+WOW_RUNNING_DOWNLOAD_RATE_LIMIT_BPS = 256 * 1024
+API_BULK_ENDPOINTS = ["auctiondb", "auctiondb_patch", "shopping", "addon", "app", "backup", "backup_chunk"]
+# leaves some of the API_MAX_REQUESTS_PER_HOST connections free for small requests (i.e. status)
+API_MAX_BULK_REQUESTS = 3
+# realm data for realms which were played on within this time is downloaded (and saved) first, and the rest is
+# ordered by how far behind the server it is (in steps of REALM_DATA_STALENESS_STEP_S)
+REALM_DATA_ACTIVE_WINDOW_S = 3 * 24 * 60 * 60
+REALM_DATA_STALENESS_STEP_S = 60 * 60
 
 # Close reasons
 CLOSE_REASON_NORMAL = 0
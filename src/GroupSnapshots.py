@@ -0,0 +1,75 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from UploadWatermarks import get_content_hash
+
+# General python modules
+from hashlib import sha1
+import json
+import logging
+import os
+
+
+def get_groups_diff(old, new):
+    # returns the changes from the `old` group data to the `new` one, where `base` is the hash of the old data so the
+    # server can check that it's applying the diff to the same thing
+    old_groups = old['data']
+    new_groups = new['data']
+    return {
+        'base': get_content_hash(old),
+        'updateTime': new['updateTime'],
+        'profiles': new['profiles'],
+        'added': {k: v for k, v in new_groups.items() if k not in old_groups},
+        'changed': {k: v for k, v in new_groups.items() if k in old_groups and old_groups[k] != v},
+        'removed': [k for k in old_groups if k not in new_groups],
+    }
+
+
+class GroupSnapshots:
+    """
+    Stores the group data we last uploaded for each account / profile so we only need to upload what changed.
+    """
+    def __init__(self, path):
+        self._path = path
+        if self._path:
+            os.makedirs(self._path, exist_ok=True)
+
+
+    def _get_file_path(self, key):
+        return os.path.join(self._path, sha1(key.encode("utf8")).hexdigest() + ".json")
+
+
+    def get(self, key):
+        if not self._path:
+            return None
+        try:
+            with open(self._get_file_path(key), encoding="utf8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def put(self, key, data):
+        if not self._path:
+            return
+        path = self._get_file_path(key)
+        try:
+            with open(path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(data, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.getLogger().error("Failed to save group snapshot ({}): {}".format(key, str(e)))
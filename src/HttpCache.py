@@ -0,0 +1,139 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+from copy import deepcopy
+from hashlib import sha1
+import json
+import logging
+import os
+import threading
+
+
+class HttpCache:
+    """
+    An on-disk cache of HTTP responses which can be revalidated with conditional requests (ETag / Last-Modified).
+    Decoded JSON responses are also kept in memory so a 304 response doesn't need to be decoded again.
+    """
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._memory = {}
+        if self._path:
+            os.makedirs(self._path, exist_ok=True)
+
+
+    def _get_file_path(self, key, extension):
+        return os.path.join(self._path, sha1(key.encode("utf8")).hexdigest() + extension)
+
+
+    def _read_meta(self, key):
+        try:
+            with open(self._get_file_path(key, ".json"), encoding="utf8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def get_validators(self, key):
+        # returns the headers to make a conditional request for the cached response
+        if not self._path:
+            return {}
+        meta = self._read_meta(key)
+        if not meta:
+            return {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+
+    def get(self, key):
+        # returns the cached (content_type, value) or None, where value is a decoded JSON object or bytes
+        with self._lock:
+            if key in self._memory:
+                content_type, value = self._memory[key]
+                return content_type, deepcopy(value)
+        meta = self._read_meta(key)
+        if not meta:
+            return None
+        body_path = self._get_file_path(key, ".body")
+        try:
+            with open(body_path, "rb") as f:
+                value = f.read()
+            # update the modified time so we evict the least recently used responses first
+            os.utime(body_path)
+        except OSError:
+            return None
+        if meta['content_type'] == "application/json":
+            value = json.loads(value.decode("utf8"))
+            with self._lock:
+                self._memory[key] = (meta['content_type'], deepcopy(value))
+        return meta['content_type'], value
+
+
+    def put(self, key, headers, content_type, body, value=None):
+        # stores a response (the `value` is the decoded JSON response, if applicable) if it can be revalidated later
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not self._path or not (etag or last_modified):
+            return
+        meta = {'etag': etag, 'last_modified': last_modified, 'content_type': content_type}
+        try:
+            for extension, data in ((".body", body), (".json", json.dumps(meta).encode("utf8"))):
+                path = self._get_file_path(key, extension)
+                # the same response may be stored by more than one thread at once (i.e. hedged requests)
+                temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+        except OSError as e:
+            logging.getLogger().error("Failed to cache response ({}): {}".format(key, str(e)))
+            return
+        if value is not None:
+            with self._lock:
+                self._memory[key] = (content_type, deepcopy(value))
+        self._trim()
+
+
+    def _trim(self):
+        # remove the least recently used responses until we're within the size limit
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self._path):
+            if not file_name.endswith(".body"):
+                continue
+            path = os.path.join(self._path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            for file_path in (path, path[:-len(".body")] + ".json"):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+            total_size -= size
+        with self._lock:
+            self._memory = {key: value for key, value in self._memory.items() if os.path.isfile(self._get_file_path(key, ".body"))}
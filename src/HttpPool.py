@@ -0,0 +1,197 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+from collections import deque
+import http.client
+import logging
+import socket
+import threading
+from time import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+
+# the errors we get when the server has closed an idle connection before we (re)used it
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+class HttpPool:
+    """
+    Keeps idle HTTP connections open per host so they can be reused (keep-alive) and caches DNS lookups.
+    """
+    def __init__(self, timeout, idle_timeout, dns_ttl, max_timings=200):
+        # `timeout` is the default (connect, read) timeout in seconds
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._dns_ttl = dns_ttl
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._dns = {}
+        self._timings = deque(maxlen=max_timings)
+
+
+    def _resolve(self, host, port):
+        with self._lock:
+            address, expires = self._dns.get((host, port), (None, 0))
+        if address and expires > time():
+            return address
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+        with self._lock:
+            self._dns[(host, port)] = (address, time() + self._dns_ttl)
+        return address
+
+
+    def _get_connection(self, host, port):
+        # returns an idle connection to the host if there is one or a new one otherwise
+        with self._lock:
+            idle = self._idle.get((host, port), [])
+            while idle:
+                connection, last_used = idle.pop()
+                if time() - last_used < self._idle_timeout:
+                    return connection, True
+                connection.close()
+        return http.client.HTTPConnection(self._resolve(host, port), port), False
+
+
+    def _release_connection(self, host, port, connection):
+        with self._lock:
+            self._idle.setdefault((host, port), []).append((connection, time()))
+
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle = {}
+
+
+    def get_timings(self):
+        # returns a list of (path, seconds, reused_connection) for the most recent requests
+        with self._lock:
+            return list(self._timings)
+
+
+    def _send_chunked(self, connection, path, chunks, headers):
+        # sends the body with chunked transfer encoding as the chunks are generated
+        connection.putrequest("POST", path, skip_host=True, skip_accept_encoding='Accept-Encoding' in headers)
+        for name, value in headers.items():
+            connection.putheader(name, value)
+        connection.putheader("Transfer-Encoding", "chunked")
+        connection.endheaders()
+        for chunk in chunks:
+            if chunk:
+                connection.send("{:x}\r\n".format(len(chunk)).encode("ascii") + chunk + b"\r\n")
+        connection.send(b"0\r\n\r\n")
+
+
+    def request(self, url, data=None, headers=None, timeout=None):
+        # `data` is either bytes or a function which returns an iterable of bytes to be streamed (this is called again
+        # if the request needs to be retried) and `timeout` is an optional (connect, read) timeout
+        parts = urlsplit(url)
+        host = parts.hostname
+        port = parts.port or 80
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = dict(headers or {})
+        headers['Host'] = parts.netloc
+        headers['Connection'] = "keep-alive"
+        start_time = time()
+        while True:
+            connection, reused = self._get_connection(host, port)
+            connect_timeout, read_timeout = timeout or self._timeout
+            sent = False
+            try:
+                if not connection.sock:
+                    connection.timeout = connect_timeout
+                    connection.connect()
+                connection.sock.settimeout(read_timeout)
+                if callable(data):
+                    self._send_chunked(connection, path, data(), headers)
+                else:
+                    connection.request("POST" if data is not None else "GET", path, data, headers)
+                sent = True
+                response = connection.getresponse()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if not reused:
+                    # the cached address might be the problem
+                    with self._lock:
+                        self._dns.pop((host, port), None)
+                    raise
+                if not isinstance(e, _STALE_CONNECTION_ERRORS) or (sent and data is not None):
+                    # this isn't just a stale connection, or the server may have already gotten the whole upload
+                    raise
+                # the server closed this idle connection, so try again with a new one
+        elapsed = time() - start_time
+        with self._lock:
+            self._timings.append((parts.path, elapsed, reused))
+        logging.getLogger().debug("Got response in {:.0f}ms ({} connection)".format(elapsed * 1000, "reused" if reused else "new"))
+        if response.status == 304:
+            # there's no body, but it still needs to be read so the connection can be reused
+            response.read()
+        elif response.status < 200 or response.status >= 300:
+            response.read()
+            connection.close()
+            raise HTTPError(url, response.status, response.reason, response.msg, None)
+        return _PooledResponse(self, host, port, connection, response)
+
+
+class _PooledResponse:
+    # wraps a response so the connection goes back to the pool once the response has been completely read
+    def __init__(self, pool, host, port, connection, response):
+        self._pool = pool
+        self._host = host
+        self._port = port
+        self._connection = connection
+        self._response = response
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    @property
+    def status(self):
+        return self._response.status
+
+
+    def info(self):
+        return self._response.msg
+
+
+    def read(self, *args):
+        return self._response.read(*args)
+
+
+    def readinto(self, b):
+        return self._response.readinto(b)
+
+
+    def close(self):
+        if not self._connection:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._release_connection(self._host, self._port, self._connection)
+        else:
+            self._response.close()
+            self._connection.close()
+        self._connection = None
@@ -15,17 +15,22 @@
 
 
 # Local modules
-from AppAPI import AppAPI, ApiError, ApiTransientError
+from AddonCache import AddonCache
+from AppAPI import AppAPI, ApiError, ApiSessionError, ApiTransientError
 from Backup import Backup
+from BackupSync import BackupSync
 import Config
 import PrivateConfig
+from RealmDataScheduler import RealmDataScheduler
+from RetryPolicy import RetryPolicy
 from Settings import load_settings
+from UploadQueue import UploadQueue
 from WoWHelper import WoWHelper
 
 # PyQt5
 from PyQt5.QtCore import pyqtSignal, QDateTime, QMutex, QSettings, QStandardPaths, QThread, QVariant, QWaitCondition, Qt, QUrl
 from PyQt5.QtGui import QDesktopServices, QIcon
-from PyQt5.QtWidgets import QMessageBox
+from PyQt5.QtWidgets import QInputDialog, QMessageBox
 
 # General python modules
 from datetime import datetime
@@ -33,8 +38,8 @@ from enum import Enum
 from hashlib import md5, sha512
 from io import BytesIO
 import logging
+from lzma import LZMAError
 import os
-import psutil
 from random import randint
 import re
 import shutil
@@ -42,7 +47,8 @@ import sys
 from time import sleep, strftime, time
 import traceback
 import uuid
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
+import zlib
 
 
 class MainThread(QThread):
@@ -70,7 +76,7 @@ class MainThread(QThread):
             elif new_state == MainThread.State.PENDING_NEW_SESSION:
                 return old_state == MainThread.State.SLEEPING
             elif new_state == MainThread.State.VALID_SESSION:
-                return old_state in [MainThread.State.LOGGED_OUT, MainThread.State.PENDING_NEW_SESSION]
+                return old_state in [MainThread.State.INIT, MainThread.State.LOGGED_OUT, MainThread.State.PENDING_NEW_SESSION]
             elif new_state == MainThread.State.SLEEPING:
                 return old_state == MainThread.State.VALID_SESSION
 
@@ -156,6 +162,11 @@ class MainThread(QThread):
 
         # initialize other helper classes
         self._api = AppAPI()
+        self._backup_sync = BackupSync(self._api)
+        self._login_retry_policy = RetryPolicy(Config.LOGIN_RETRY_BASE_DELAY_S, Config.LOGIN_RETRY_MAX_DELAY_S)
+        self._login_failures = 0
+        self._upload_queue = UploadQueue(Config.UPLOAD_QUEUE_DIR_PATH, Config.UPLOAD_QUEUE_MIN_RETRY_S, Config.UPLOAD_QUEUE_MAX_RETRY_S)
+        self._addon_cache = AddonCache(Config.ADDON_CACHE_DIR_PATH, Config.ADDON_CACHE_MAX_SIZE)
         self._wow_helper = WoWHelper()
         self._wow_helper.addons_folder_changed.connect(self._update_addon_status)
 
@@ -238,50 +249,55 @@ class MainThread(QThread):
             self._update_addon_status()
         elif table == "backup":
             # check that WoW isn't running
-            for p in psutil.process_iter():
-                try:
-                    if p.cwd() == self._settings.wow_path:
-                        # WoW is running
-                        msg_box = QMessageBox()
-                        msg_box.setWindowIcon(QIcon(":/resources/logo.png"))
-                        msg_box.setWindowModality(Qt.ApplicationModal)
-                        msg_box.setIcon(QMessageBox.Warning)
-                        msg_box.setText("WoW cannot be open while restoring a backup. Please close WoW and try again.")
-                        msg_box.setStandardButtons(QMessageBox.Ok)
-                        msg_box.exec_()
-                        return
-                except:
-                    pass
-            backup = self._backups[int(parts[0])]
-            if backup.is_local:
-                success = self._wow_helper.restore_backup(backup)
+            if self._wow_helper.is_wow_running():
                 msg_box = QMessageBox()
                 msg_box.setWindowIcon(QIcon(":/resources/logo.png"))
                 msg_box.setWindowModality(Qt.ApplicationModal)
-                msg_box.setIcon(QMessageBox.Information if success else QMessageBox.Warning)
-                msg_box.setText("Restored backup successfully!" if success else "Failed to restore backup!")
+                msg_box.setIcon(QMessageBox.Warning)
+                msg_box.setText("WoW cannot be open while restoring a backup. Please close WoW and try again.")
                 msg_box.setStandardButtons(QMessageBox.Ok)
                 msg_box.exec_()
-            else:
-                # download the backup first
+                return
+            backup = self._backups[int(parts[0])]
+            success = False
+            temp_path = os.path.join(self._temp_backup_path, backup.get_remote_zip_name())
+            if not backup.is_local:
+                # download the backup first (streaming it to a temporary file)
                 try:
-                    zip_data = self._api.backup(backup.get_remote_zip_name())
-                    temp_path = os.path.join(self._temp_backup_path, backup.get_remote_zip_name())
-                    with open(temp_path, "wb") as f:
-                        f.write(zip_data)
-                    success = self._wow_helper.restore_backup(backup)
+                    with open(temp_path + ".part", "wb") as f:
+                        if self._backup_sync.is_supported():
+                            # reuse chunks from our local backups of this account
+                            self._backup_sync.download(backup.get_remote_zip_name(), f, self._get_local_backup_paths(backup.account))
+                        else:
+                            self._api.backup(backup.get_remote_zip_name(), dst=f)
+                    os.replace(temp_path + ".part", temp_path)
+                except (ApiError, ApiTransientError, OSError, KeyError, TypeError, ValueError) as e:
+                    # (a malformed manifest results in a KeyError / TypeError / ValueError)
+                    self._logger.error("Failed to download backup ({}): {}".format(backup.get_remote_zip_name(), str(e)))
+                    try:
+                        os.remove(temp_path + ".part")
+                    except OSError:
+                        pass
+                    backup = None
+            if backup:
+                # let the user pick which addon's settings to restore
+                files = self._wow_helper.get_backup_files(backup)
+                items = ["All addons"] + files
+                item, ok = QInputDialog.getItem(None, "Restore Backup", "Select the addon settings to restore:", items, 0, False)
+                if ok:
+                    success = self._wow_helper.restore_backup(backup, None if item == items[0] else [item])
+                if not backup.is_local:
                     # remove the temporary file
                     os.remove(temp_path)
-                except (ApiError, ApiTransientError) as e:
-                    self._logger.error("Got error from backup API: {}".format(str(e)))
-                    success = False
-                msg_box = QMessageBox()
-                msg_box.setWindowIcon(QIcon(":/resources/logo.png"))
-                msg_box.setWindowModality(Qt.ApplicationModal)
-                msg_box.setIcon(QMessageBox.Information if success else QMessageBox.Warning)
-                msg_box.setText("Restored backup successfully!" if success else "Failed to restore backup!")
-                msg_box.setStandardButtons(QMessageBox.Ok)
-                msg_box.exec_()
+                if not ok:
+                    return
+            msg_box = QMessageBox()
+            msg_box.setWindowIcon(QIcon(":/resources/logo.png"))
+            msg_box.setWindowModality(Qt.ApplicationModal)
+            msg_box.setIcon(QMessageBox.Information if success else QMessageBox.Warning)
+            msg_box.setText("Restored backup successfully!" if success else "Failed to restore backup!")
+            msg_box.setStandardButtons(QMessageBox.Ok)
+            msg_box.exec_()
         elif table == "changes":
             addon = parts.pop(0)
             if addon == "TradeSkillMaster":
@@ -297,13 +313,13 @@ class MainThread(QThread):
 
 
     def upload_log_file(self):
-        data = None
-        with open(Config.LOG_FILE_PATH) as log_file:
-            data = log_file.read()
-        if not data:
+        if not os.path.getsize(Config.LOG_FILE_PATH):
             self.log_uploaded.emit(False)
+            return
         try:
-            self._api.log(data)
+            # stream the log rather than reading it all into memory
+            with open(Config.LOG_FILE_PATH) as log_file:
+                self._api.log(log_file)
             self.log_uploaded.emit(True)
         except (ApiTransientError, ApiError) as e:
             self.log_uploaded.emit(False)
@@ -333,13 +349,27 @@ class MainThread(QThread):
     def _download_addon(self, addon):
         self._logger.info("Downloading {}".format(addon))
         try:
-            with ZipFile(BytesIO(self._api.addon(addon))) as zip:
+            with ZipFile(BytesIO(self._get_addon_package(addon))) as zip:
                 self._wow_helper.install_addon(addon, zip)
         except (ApiTransientError, ApiError) as e:
             # either the user or we will try again later
             self._logger.error("Addon download error: {}".format(str(e)))
 
 
+    def _get_addon_package(self, addon):
+        # returns the zip for the latest version of the addon, which only needs to be downloaded if we haven't before
+        version = next((x['version'] for x in self._addon_versions if x['name'] == addon), None)
+        if version is not None:
+            data = self._addon_cache.get(addon, version)
+            if data:
+                self._logger.info("Using cached package for {} ({})".format(addon, version))
+                return data
+        data = self._api.addon(addon)
+        if version is not None:
+            self._addon_cache.put(addon, version, data)
+        return data
+
+
     def _set_fsm_state(self, new_state):
         if new_state == self._state:
             # already in the desired state
@@ -372,8 +402,8 @@ class MainThread(QThread):
         elif new_state == self.State.VALID_SESSION:
             self.set_main_window_premium_button_visible.emit(not self._api.get_is_premium())
             self.settings_changed.emit()
-            if old_state == self.State.LOGGED_OUT:
-                # we just logged in so clean up a few things
+            if old_state in [self.State.INIT, self.State.LOGGED_OUT]:
+                # we just logged in (or restored our last session) so clean up a few things
                 if not self._wow_helper.has_valid_wow_path():
                     self._wow_helper.find_wow_path()
                 # reset the login window
@@ -394,6 +424,7 @@ class MainThread(QThread):
             self._api.login(self._settings.email, self._settings.password)
             # the login was successful!
             self._logger.info("Logged in successfully ({})!".format(self._api.get_username()))
+            self._login_failures = 0
             self._set_fsm_state(self.State.VALID_SESSION)
         except (ApiTransientError, ApiError) as e:
             # either the user or we will try again later
@@ -403,8 +434,10 @@ class MainThread(QThread):
                 self._settings.password = ""
                 self._set_fsm_state(self.State.LOGGED_OUT)
             else:
-                # try again in 1 minute
-                self.sleep(60)
+                # try again later, backing off more the longer we've been failing
+                self._sleep_time = int(self._login_retry_policy.get_delay(self._login_failures))
+                self._login_failures += 1
+                self._logger.info("Retrying login in {}s".format(self._sleep_time))
             return str(e)
 
     def _login(self):
@@ -464,6 +497,7 @@ class MainThread(QThread):
         installed_addons = []
         install_all = False
         download_notifications = []
+        addon_downloads = []
         for addon in self._addon_versions:
             latest_version = addon['version']
             version_type, version_int, version_str = self._wow_helper.get_installed_version(addon['name'])
@@ -477,15 +511,24 @@ class MainThread(QThread):
                     self._wow_helper.delete_addon(addon['name'])
                 elif version_int < latest_version and self._api.get_is_premium():
                     # update this addon
-                    self._download_addon(addon['name'])
-                    if self._settings.addon_notification:
-                        download_notifications.append("Downloaded {} {}".format(addon['name'], self._wow_helper.get_installed_version(addon['name'])[2]))
+                    addon_downloads.append(addon['name'])
                     installed_addons.append(addon['name'])
                 else:
                     installed_addons.append(addon['name'])
             else:
                 # this is a Dev version
                 installed_addons.append(addon['name'])
+        if addon_downloads and self._is_endpoint_down("addon"):
+            addon_downloads = []
+        # download the updates concurrently and install them as they come back (in order)
+        for addon, (data, error) in zip(addon_downloads, self._api.run_concurrently([(self._get_addon_package, x) for x in addon_downloads])):
+            if error:
+                self._logger.error("Addon download error: {}".format(str(error)))
+                continue
+            with ZipFile(BytesIO(data)) as addon_zip:
+                self._wow_helper.install_addon(addon, addon_zip)
+            if self._settings.addon_notification:
+                download_notifications.append("Downloaded {} {}".format(addon, self._wow_helper.get_installed_version(addon)[2]))
         if len(download_notifications) > 2:
             self.show_desktop_notification.emit("Downloading addon updates!", False)
         else:
@@ -498,17 +541,16 @@ class MainThread(QThread):
                 self.show_desktop_notification.emit("Created backup for {}".format(backup.account), False)
         if self._api.get_is_premium():
             # send the new backups to the TSM servers
-            for backup in new_backups:
-                zip_path = os.path.abspath(os.path.join(Config.BACKUP_DIR_PATH, backup.get_local_zip_name()))
-                with open(zip_path, "rb") as f:
-                    self._logger.info("Uploading backup: {}".format(backup.get_remote_zip_name()))
-                    try:
-                        self._api.backup(backup.get_remote_zip_name(), f.read())
-                    except (ApiError, ApiTransientError) as e:
-                        self._logger.error("Got error from backup API: {}".format(str(e)))
+            for backup, (_, error) in zip(new_backups, self._api.run_concurrently([(self._upload_backup, x) for x in new_backups])):
+                if error:
+                    self._logger.error("Got error from backup API: {}".format(str(error)))
+                if isinstance(error, ApiTransientError):
+                    # try again later
+                    self._upload_queue.put("backup", [backup.get_remote_zip_name(), backup.get_local_zip_name()], None, 0)
 
         # set the list of backups to just the local ones first
         self._backups = self._wow_helper.get_backups()
+        remote_backup_info = None
         if self._api.get_is_premium():
             self._set_main_window_status("One moment. Getting backup status...", False)
             # get remote backups
@@ -536,6 +578,17 @@ class MainThread(QThread):
                                     break
                         if not tracked:
                             self._backups.append(backup)
+        if self._api.get_is_premium() and remote_backup_info is None:
+            # we don't know which backups the server is keeping, so don't purge any until we do
+            self._logger.warning("Not purging backups since we couldn't get the remote backups")
+        else:
+            # purge old local backups now that we know which ones should be kept (except ones which still need uploading)
+            pending_uploads = [x.get_local_zip_name() for x in self._backups if x.is_local and self._upload_queue.has("backup", [x.get_remote_zip_name(), x.get_local_zip_name()])]
+            for backup in self._wow_helper.purge_backups(self._backups, pending_uploads):
+                if backup.is_remote:
+                    backup.is_local = False
+                else:
+                    self._backups.remove(backup)
         self._update_backup_status()
 
         # update addon status again incase we changed something (i.e. downloaded updates or deleted an old addon)
@@ -591,48 +644,56 @@ class MainThread(QThread):
                 raise Exception("Invalid type {}".format(info['type']))
 
         hit_error = False
-
-        # get auctiondb updates
-        self._set_main_window_status("One moment. Downloading AuctionDB data...", False)
-        updated_realms = []
-        for key, realms in auctiondb_updates.items():
-            type, id = key
-            try:
-                data = self._api.auctiondb(type, str(id))['data']
-                if type == "realm":
-                    for realm_id in realms:
-                        realm_name, last_modified = next((x['name'], x['lastModified']) for x in result['realms'] if x['id'] == realm_id)
-                        app_data.update("AUCTIONDB_MARKET_DATA", realm_name, data, last_modified)
-                        updated_realms.append(realm_name)
-                elif type == "region":
-                    region_name, last_modified = next((x['name'], x['lastModified']) for x in result['regions'] if x['id'] == id)
-                    app_data.update("AUCTIONDB_MARKET_DATA", region_name, data, last_modified)
-                    updated_realms.append(region_name)
-                else:
-                    raise Exception("Invalid type {}".format(type))
-            except (ApiError, ApiTransientError) as e:
-                # log an error and keep going
-                self._logger.error("Got error from AuctionDB API: {}".format(str(e)))
-                hit_error = True
-        if not hit_error and self._settings.realm_data_notification and updated_realms:
-            self.show_desktop_notification.emit("Updated AuctionDB data for {}".format(" / ".join(updated_realms)), False)
-
-        # get shopping updates
-        self._set_main_window_status("One moment. Downloading great deals data...", False)
-        updated_realms = []
-        for id, realms in shopping_updates.items():
-            try:
-                shopping_data = self._api.shopping(str(id))['data']
-                for realm_id in realms:
-                    realm_name, last_modified = next((x['name'], x['lastModified']) for x in result['realms'] if x['id'] == realm_id)
-                    app_data.update("SHOPPING_SEARCHES", realm_name, shopping_data, last_modified)
-                    updated_realms.append(realm_name)
-            except (ApiError, ApiTransientError) as e:
+        if auctiondb_updates and self._is_endpoint_down("auctiondb"):
+            auctiondb_updates = {}
+            hit_error = True
+        if shopping_updates and self._is_endpoint_down("shopping"):
+            shopping_updates = {}
+            hit_error = True
+
+        # schedule the downloads so the data for the realms which matter most lands first
+        scheduler = RealmDataScheduler(self._wow_helper.get_realm_activity(), Config.REALM_DATA_ACTIVE_WINDOW_S, Config.REALM_DATA_STALENESS_STEP_S)
+        for (type, id), realm_ids in auctiondb_updates.items():
+            if type == "realm":
+                targets = [(x['name'], x['lastModified']) for x in result['realms'] if x['id'] in realm_ids]
+                realm_names = [x[0] for x in targets]
+            elif type == "region":
+                targets = [(x['name'], x['lastModified']) for x in result['regions'] if x['id'] == id]
+                # region data is used on all the realms
+                realm_names = [x['name'] for x in result['realms']]
+            else:
+                raise Exception("Invalid type {}".format(type))
+            self._add_realm_data_job(scheduler, app_data, "AUCTIONDB_MARKET_DATA", targets, realm_names, (self._download_auctiondb, app_data, result, type, id, realm_ids))
+        for id, realm_ids in shopping_updates.items():
+            targets = [(x['name'], x['lastModified']) for x in result['realms'] if x['id'] in realm_ids]
+            self._add_realm_data_job(scheduler, app_data, "SHOPPING_SEARCHES", targets, [x[0] for x in targets], (self._download_shopping, app_data, id))
+
+        # download the realm data, updating the app data as each download finishes
+        self._set_main_window_status("One moment. Downloading realm data...", False)
+        updated_realms = {'AUCTIONDB_MARKET_DATA': [], 'SHOPPING_SEARCHES': []}
+        jobs = scheduler.get_jobs()
+        for i, payload, error in self._api.run_as_completed([call for (_, _, call), _ in jobs], Config.API_MAX_BULK_REQUESTS):
+            (data_type, targets, _), is_active = jobs[i]
+            if error:
                 # log an error and keep going
-                self._logger.error("Got error from Shopping API: {}".format(str(e)))
+                self._logger.error("Got error from {} API: {}".format("AuctionDB" if data_type == "AUCTIONDB_MARKET_DATA" else "Shopping", str(error)))
                 hit_error = True
-        if not hit_error and self._settings.realm_data_notification and updated_realms:
-            self.show_desktop_notification.emit("Updated Great Deals for {}".format(" / ".join(updated_realms)), False)
+                continue
+            for realm_name, last_modified in targets:
+                app_data.update_from_payload(data_type, realm_name, payload, last_modified)
+                updated_realms[data_type].append(realm_name)
+            if is_active:
+                # save the data for realms which are being played on right away rather than waiting for the rest
+                try:
+                    app_data.save(close_payloads=False)
+                except OSError as e:
+                    self._logger.error("Failed to save app data: {}".format(str(e)))
+            self._update_data_sync_status()
+        if not hit_error and self._settings.realm_data_notification:
+            if updated_realms['AUCTIONDB_MARKET_DATA']:
+                self.show_desktop_notification.emit("Updated AuctionDB data for {}".format(" / ".join(updated_realms['AUCTIONDB_MARKET_DATA'])), False)
+            if updated_realms['SHOPPING_SEARCHES']:
+                self.show_desktop_notification.emit("Updated Great Deals for {}".format(" / ".join(updated_realms['SHOPPING_SEARCHES'])), False)
 
         tsm_version_type, tsm_version_int, _ = self._wow_helper.get_installed_version("TradeSkillMaster")
         if tsm_version_type == WoWHelper.RELEASE_VERSION and tsm_version_int >= app_info['minTSMUpdateNotificationVersion']:
@@ -651,6 +712,91 @@ class MainThread(QThread):
             self._set_main_window_status("{}<br>Everything is up to date as of {}.".format(app_info['news'], QDateTime.currentDateTime().toString(Qt.SystemLocaleShortDate)))
 
 
+    def _is_endpoint_down(self, endpoint):
+        # skip the work for endpoints which are known to be down so the rest of the cycle can keep going
+        if not self._api.is_endpoint_down(endpoint):
+            return False
+        self._logger.warning("Skipping {} requests this cycle since the server is unavailable".format(endpoint))
+        return True
+
+
+    def _upload_backup(self, backup):
+        self._upload_backup_zip(backup.get_remote_zip_name(), backup.get_local_zip_name())
+
+
+    def _upload_backup_zip(self, remote_name, local_name):
+        zip_path = os.path.abspath(os.path.join(Config.BACKUP_DIR_PATH, local_name))
+        if not os.path.isfile(zip_path):
+            # this backup has since been purged
+            self._logger.info("Not uploading missing backup: {}".format(remote_name))
+            return
+        self._logger.info("Uploading backup: {}".format(remote_name))
+        try:
+            if self._backup_sync.is_supported():
+                # only upload the chunks which the server doesn't already have
+                account = Backup(zip_name=local_name, is_local=True, is_remote=False).account
+                self._backup_sync.upload(remote_name, zip_path, self._get_local_backup_paths(account, local_name))
+            else:
+                with open(zip_path, "rb") as f:
+                    self._api.backup(remote_name, f)
+        except OSError as e:
+            # the backup couldn't be read (or changed while we were uploading it), so try again later
+            self._logger.error("Failed to read backup ({}): {}".format(zip_path, str(e)))
+            raise ApiTransientError("Failed to read backup")
+        except (BadZipFile, EOFError, LZMAError, zlib.error) as e:
+            # the backup is corrupted, so there's no point trying to upload it again
+            self._logger.error("Backup is corrupted ({}): {}".format(zip_path, str(e)))
+            raise ApiError("Backup is corrupted")
+
+
+    def _get_local_backup_paths(self, account, exclude=None):
+        # returns the paths of the local backups of the account (most recent first)
+        backups = sorted((x for x in self._backups if x.is_local and x.account == account), key=lambda x: x.timestamp, reverse=True)
+        return [os.path.join(Config.BACKUP_DIR_PATH, x.get_local_zip_name()) for x in backups if x.get_local_zip_name() != exclude]
+
+
+    def _add_realm_data_job(self, scheduler, app_data, data_type, targets, realm_names, call):
+        # `targets` are the (name, last_modified) of the entries the download updates
+        staleness = max(last_modified - app_data.last_update(data_type, name) for name, last_modified in targets)
+        size = max(app_data.get_size(data_type, name) for name, _ in targets)
+        scheduler.add((data_type, targets, call), realm_names, staleness, size)
+
+
+    def _download_auctiondb(self, app_data, status, type, id, realms):
+        payload = self._get_auctiondb_patch(app_data, status, type, id, realms)
+        if not payload:
+            # stream the data straight into a payload rather than holding it in memory
+            with app_data.new_payload() as payload:
+                payload.store_raw = self._api.auctiondb(type, str(id), dst=payload)
+        return payload
+
+
+    def _download_shopping(self, app_data, id):
+        with app_data.new_payload() as payload:
+            payload.store_raw = self._api.shopping(str(id), dst=payload)
+        return payload
+
+
+    def _get_auctiondb_patch(self, app_data, status, type, id, realms):
+        # try to update the AuctionDB data we already have by applying a patch rather than downloading all of it
+        if not self._api.has_endpoint("auctiondb_patch"):
+            return None
+        if type == "realm":
+            names = [x['name'] for x in status['realms'] if x['id'] in realms]
+        else:
+            names = [x['name'] for x in status['regions'] if x['id'] == id]
+        last_updates = set(app_data.last_update("AUCTIONDB_MARKET_DATA", name) for name in names)
+        if len(last_updates) != 1 or 0 in last_updates:
+            # we don't have a single version of the data to patch
+            return None
+        try:
+            patch = self._api.auctiondb_patch(type, str(id), last_updates.pop())
+        except (ApiError, ApiTransientError) as e:
+            self._logger.info("Could not get AuctionDB patch ({}, {}): {}".format(type, id, str(e)))
+            return None
+        return app_data.apply_patch("AUCTIONDB_MARKET_DATA", names[0], patch['ops'], patch['md5'])
+
+
     def _update_addon_status(self):
         # check addon versions
         addon_status = []
@@ -747,58 +893,95 @@ class MainThread(QThread):
         self.set_main_window_backup_status_data.emit(backup_status)
 
 
+    def _replay_upload_queue(self):
+        # retry some of the uploads which previously failed (limited so we don't flood the server after an outage)
+        jobs = []
+        for endpoint, args, data, update_time in self._upload_queue.get_due(Config.UPLOAD_QUEUE_MAX_REPLAY):
+            if endpoint == "sales":
+                # some of these sales may have been uploaded since (i.e. by an earlier chunk)
+                try:
+                    last_upload = self._api.sales(*args)
+                except (ApiError, ApiTransientError) as e:
+                    self._logger.error("Got error from sales API: {}".format(str(e)))
+                    self._upload_queue.failed(endpoint, args)
+                    continue
+                data = [x for x in data if x[5] > last_upload]
+                if not data:
+                    self._upload_queue.remove(endpoint, args)
+                    continue
+            jobs.append((endpoint, args, data, update_time))
+        if not jobs:
+            return
+        backup_jobs = [x for x in jobs if x[0] == "backup"]
+        data_jobs = [x for x in jobs if x[0] != "backup"]
+        results = self._api.run_concurrently([(self._upload_backup_zip,) + tuple(x[1]) for x in backup_jobs])
+        results += self._api.upload_batch(data_jobs)
+        for (endpoint, args, _, _), (_, error) in zip(backup_jobs + data_jobs, results):
+            # the upload itself wasn't rejected if our session expired, so it's kept for after we log in again
+            if isinstance(error, (ApiTransientError, ApiSessionError)):
+                self._upload_queue.failed(endpoint, args)
+                continue
+            if error:
+                self._logger.error("Dropping queued {} upload {} after error: {}".format(endpoint, args, str(error)))
+            else:
+                self._logger.info("Uploaded queued {} data {}".format(endpoint, args))
+            self._upload_queue.remove(endpoint, args)
+        self._logger.info("{} uploads are still queued".format(len(self._upload_queue)))
+
+
     def _upload_data(self):
-        # upload black market data
+        self._replay_upload_queue()
+        # figure out which sales are new first (we'll generally already know the last upload time locally) - skipping any
+        # which are already queued to be uploaded
+        accounting_data = [(k, v) for k, v in self._wow_helper.get_accounting_data().items() if not self._upload_queue.has("sales", list(k), v['updateTime'])]
+        sales_results = self._api.run_concurrently([(self._get_new_sales_data, region, realm, account, data) for (region, realm, account), data in accounting_data])
+        # all the uploads are sent together as one batch and we then log the results in order
+        uploads = []
         for key, data in self._wow_helper.get_black_market_data().items():
             region, realm = key
-            try:
-                if self._api.black_market(region, realm, data, data['updateTime']):
-                    self._logger.info("Uploaded black market data ({}, {})!".format(region, realm))
-            except (ApiError, ApiTransientError) as e:
-                self._logger.error("Got error from black market API: {}".format(str(e)))
-
-        # upload WoW token data
+            uploads.append(("black market", "({}, {})".format(region, realm), ("black_market", [region, realm], data, data['updateTime'])))
         for region, data in self._wow_helper.get_wow_token_data().items():
-            try:
-                if self._api.wow_token(region, data, data['updateTime']):
-                    self._logger.info("Uploaded WoW token data ({})!".format(region))
-            except (ApiError, ApiTransientError) as e:
-                self._logger.error("Got error from black market API: {}".format(str(e)))
-
-        # upload analytics data
+            uploads.append(("WoW token", "({})".format(region), ("wow_token", [region], data, data['updateTime'])))
         for account, data in self._wow_helper.get_analytics_data().items():
-            try:
-                if self._api.analytics(account, data, data['updateTime']):
-                    self._logger.info("Uploaded analytics data ({})!".format(account))
-            except (ApiError, ApiTransientError) as e:
-                self._logger.error("Got error from analytics API: {}".format(str(e)))
-
-        # upload sales data
-        for key, data in self._wow_helper.get_accounting_data().items():
-            region, realm, account = key
-            try:
-                last_upload = self._api.sales(region, realm, account)
-                if last_upload < data['updateTime']:
-                    new_data = []
-                    for item_id, sales in data['data'].items():
-                        new_data.extend([[item_id] + x for x in sales if x[4] > last_upload])
-                    if new_data:
-                        # upload the new data
-                        self._api.sales(region, realm, account, new_data)
-                        self._logger.info("Uploaded sales data ({}, {}, {})!".format(region, realm, account))
-            except (ApiError, ApiTransientError) as e:
-                self._logger.error("Got error from sales API: {}".format(str(e)))
-
-        # upload group data
+            uploads.append(("analytics", "({})".format(account), ("analytics", [account], data, data['updateTime'])))
+        for ((region, realm, account), data), (new_data, error) in zip(accounting_data, sales_results):
+            key_text = "({}, {}, {})".format(region, realm, account)
+            if error:
+                self._logger.error("Got error from sales API: {}".format(str(error)))
+            elif not new_data:
+                self._logger.debug("sales data hasn't changed {}!".format(key_text))
+            else:
+                uploads.append(("sales", key_text, ("sales", [region, realm, account], new_data, data['updateTime'])))
         for key, data in self._wow_helper.get_group_data().items():
             account, profile = key
-            try:
-                if self._api.groups(account, profile, data, data['updateTime']):
-                    self._logger.info("Uploaded group data ({}, {})!".format(account, profile))
-                else:
-                    self._logger.debug("Group data hasn't changed ({}, {})!".format(account, profile))
-            except (ApiError, ApiTransientError) as e:
-                self._logger.error("Got error from group API: {}".format(str(e)))
+            uploads.append(("group", "({}, {})".format(account, profile), ("groups", [account, profile], data, data['updateTime'])))
+        # if we've already queued this exact upload, it'll get retried from the queue
+        uploads = [x for x in uploads if not self._upload_queue.has(x[2][0], x[2][1], x[2][3])]
+        results = self._api.upload_batch([x[2] for x in uploads])
+        for (name, key_text, (endpoint, args, data, update_time)), (uploaded, error) in zip(uploads, results):
+            if error:
+                self._logger.error("Got error from {} API: {}".format(name, str(error)))
+                if isinstance(error, ApiTransientError):
+                    # queue it to be retried without having to redo all the work of preparing the data
+                    self._upload_queue.put(endpoint, args, data, update_time)
+                continue
+            # this supersedes anything which was queued
+            self._upload_queue.remove(endpoint, args)
+            if uploaded:
+                self._logger.info("Uploaded {} data {}!".format(name, key_text))
+            else:
+                self._logger.debug("{} data hasn't changed {}!".format(name, key_text))
+
+
+    def _get_new_sales_data(self, region, realm, account, data):
+        # returns the sales which are newer than the last upload
+        last_upload = self._api.sales(region, realm, account)
+        if last_upload >= data['updateTime']:
+            return []
+        new_data = []
+        for item_id, sales in data['data'].items():
+            new_data.extend([[item_id] + x for x in sales if x[4] > last_upload])
+        return new_data
 
 
     def _get_file_md5(self, path):
@@ -883,28 +1066,48 @@ class MainThread(QThread):
         if self._state == self.State.INIT:
             # just go to the next state - this is so we can show the login window when we enter LOGGED_OUT
             self.set_login_window_form_values.emit(self._settings.email, "********" if self._settings.email else "")
-            self._set_fsm_state(self.State.LOGGED_OUT)
+            if self._settings.email and self._settings.password and self._api.restore_session(self._settings.email):
+                # we still have a valid session from last time, so don't need to login again
+                self._logger.info("Restored previous session ({})".format(self._api.get_username()))
+                self._set_fsm_state(self.State.VALID_SESSION)
+            else:
+                self._set_fsm_state(self.State.LOGGED_OUT)
         elif self._state == self.State.LOGGED_OUT:
             # process login requests (which will move us to VALID_SESSION)
             self._login()
         elif self._state == self.State.PENDING_NEW_SESSION:
-            # get a new session by making a login request (which will move us to VALID_SESSION)
-            if self._login_request():
-                # we failed to login, wait before trying again
-                self._sleep_time = randint(30, 90)
+            if self._api.has_valid_session():
+                # keep using our current session until the server rejects it
+                self._set_fsm_state(self.State.VALID_SESSION)
+            else:
+                # get a new session by making a login request (which will move us to VALID_SESSION or set how long to
+                # wait before trying again)
+                self._login_request()
         elif self._state == self.State.VALID_SESSION:
             self._sleep_time = Config.STATUS_CHECK_INTERVAL_S + randint(0, 90)
+            # limit our bandwidth while WoW is running so we don't affect the game
+            self._api.set_wow_running(self._wow_helper.is_wow_running())
             self._update_app()
             if not self._wow_helper.has_valid_wow_path():
                 self.show_desktop_notification.emit("You need to select your WoW directory in the settings!", True)
                 self._set_main_window_status("<font color='red'>You need to select your WoW directory in the settings!</font>")
             else:
-                # make a status request
-                self._check_status()
-                # update the accounting tab
-                self.set_main_window_accounting_accounts.emit(self._wow_helper.get_accounting_accounts())
-                # upload app data
-                self._upload_data()
+                # don't let slow requests hold up the cycle past the next one
+                self._api.set_deadline(time() + Config.SYNC_CYCLE_DEADLINE_S)
+                try:
+                    # make a status request
+                    self._check_status()
+                    if self._api.has_valid_session():
+                        # update the accounting tab
+                        self.set_main_window_accounting_accounts.emit(self._wow_helper.get_accounting_accounts())
+                        # upload app data
+                        self._upload_data()
+                finally:
+                    self._api.set_deadline(None)
+                if not self._api.has_valid_session():
+                    # the server rejected our session, so login again right away
+                    self._logger.info("Session is no longer valid")
+                    self._sleep_time = 0
             self._set_fsm_state(self.State.SLEEPING)
         elif self._state == self.State.SLEEPING:
             # go back to PENDING_NEW_SESSION
@@ -926,7 +1129,7 @@ class MainThread(QThread):
             if os.path.isfile(prev_log_path):
                 with open(prev_log_path) as log_file:
                     try:
-                        self._api.log(log_file.read(), True)
+                        self._api.log(log_file, True)
                     except (ApiTransientError, ApiError) as e:
                         pass
         try:
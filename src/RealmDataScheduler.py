@@ -0,0 +1,47 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# General python modules
+from time import time
+
+
+class RealmDataScheduler:
+    """
+    Decides the order to download realm data (AuctionDB / Shopping) in so the most important data lands first. Jobs for
+    realms which were played on within the last `active_window` seconds come first, then the ones which are the furthest
+    behind the server (in steps of `staleness_step` seconds), and then the smallest ones.
+    """
+    def __init__(self, realm_activity, active_window, staleness_step):
+        # `realm_activity` is the last time each realm was played on by name
+        self._realm_activity = realm_activity
+        self._active_window = active_window
+        self._staleness_step = staleness_step
+        self._jobs = []
+
+
+    def add(self, job, realms, staleness, size):
+        # `realms` are the names of the realms the job updates, `staleness` is how far our data for them is behind the
+        # server (in seconds) and `size` is the size of our current copy of the data (0 if we don't have it)
+        last_active = max([self._realm_activity.get(x, 0) for x in realms] + [0])
+        is_active = time() - last_active < self._active_window
+        self._jobs.append((job, is_active, staleness, size))
+
+
+    def get_jobs(self):
+        # returns a list of (job, is_active) tuples in the order they should be done
+        jobs = sorted(self._jobs, key=lambda x: (not x[1], -(x[2] // self._staleness_step), x[3]))
+        return [(job, is_active) for job, is_active, _, _ in jobs]
@@ -0,0 +1,34 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+from random import uniform
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter: the delay before retry number `attempt` (starting at 0) is a random amount of up to
+    `base_delay * 2 ^ attempt` seconds (but at least half of it), capped at `max_delay`.
+    """
+    def __init__(self, base_delay, max_delay, max_retries=0):
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self.max_retries = max_retries
+
+
+    def get_delay(self, attempt):
+        delay = min(self._base_delay * 2 ** attempt, self._max_delay)
+        return uniform(delay / 2, delay)
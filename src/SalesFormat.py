@@ -0,0 +1,93 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+from itertools import groupby
+import json
+from operator import itemgetter
+
+
+SALES_FORMAT_VERSION = 1
+
+
+def encode_sales(rows):
+    """
+    Encodes a list of [item_id, price, stack_size, quantity, sale_time, save_time, type] sales rows into a columnar
+    format which compresses much better than the rows themselves:
+     - rows are grouped by item and sorted by sale time, with `items` holding the delta-encoded item ids and `counts`
+       holding the number of rows for each item
+     - the first sale time of each item is an offset from `baseTime` and the rest are deltas from the previous sale
+     - the (few) distinct save times are listed once in `saveTimes` (delta-encoded) and rows reference them by index
+    """
+    by_item = {}
+    for row in rows:
+        by_item.setdefault(row[0], []).append(row)
+    sorted_rows = []
+    items = []
+    counts = []
+    prev_item_id = 0
+    for item_id in sorted(by_item):
+        item_rows = by_item[item_id]
+        item_rows.sort(key=itemgetter(4))
+        sorted_rows.extend(item_rows)
+        items.append(item_id - prev_item_id)
+        counts.append(len(item_rows))
+        prev_item_id = item_id
+    columns = [list(x) for x in zip(*sorted_rows)] or [[] for _ in range(7)]
+    _, prices, stack_sizes, quantities, sale_times, row_save_times, types = columns
+    base_time = min(sale_times, default=0)
+    save_times = sorted(set(row_save_times))
+    save_time_index = {x: i for i, x in enumerate(save_times)}
+    times = [x - y for x, y in zip(sale_times, [base_time] + sale_times[:-1])]
+    index = 0
+    for count in counts:
+        # the first sale of each item is relative to the base time rather than the previous item's last sale
+        times[index] = sale_times[index] - base_time
+        index += count
+    return {
+        'version': SALES_FORMAT_VERSION,
+        'baseTime': base_time,
+        'saveTimes': [x - (save_times[i - 1] if i else 0) for i, x in enumerate(save_times)],
+        'items': items,
+        'counts': counts,
+        'price': prices,
+        'stackSize': stack_sizes,
+        'quantity': quantities,
+        'time': times,
+        'saveTime': [save_time_index[x] for x in row_save_times],
+        'type': types,
+    }
+
+
+def split_sales(rows, max_rows, max_bytes):
+    """
+    Splits the sales rows into chunks of at most `max_rows` rows and roughly `max_bytes` bytes (as JSON) in order of
+    save time, so once a chunk is uploaded, its latest save time can be used as the last upload time. Rows with the same
+    save time are never split across chunks (so a chunk may go over the budget).
+    """
+    chunk = []
+    chunk_size = 0
+    for _, group in groupby(sorted(rows, key=itemgetter(5)), key=itemgetter(5)):
+        group = list(group)
+        group_size = sum(len(json.dumps(x)) for x in group)
+        if chunk and (len(chunk) + len(group) > max_rows or chunk_size + group_size > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.extend(group)
+        chunk_size += group_size
+    if chunk:
+        yield chunk
@@ -0,0 +1,66 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# General python modules
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """
+    Limits the rate at which something (i.e. bytes) is consumed to `rate` per second, allowing bursts of up to `burst`.
+    A rate of None means there's no limit. Consuming more than is available puts the bucket into debt and blocks the
+    caller until it's paid off, so large amounts don't need to be split up.
+    """
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._burst = 0
+        self._tokens = 0
+        self._last_update = monotonic()
+        self.set_rate(rate, burst)
+
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+            self._rate = rate
+            self._burst = burst or rate or 0
+            self._tokens = min(self._tokens, self._burst)
+
+
+    def get_rate(self):
+        return self._rate
+
+
+    def _refill(self):
+        now = monotonic()
+        if self._rate:
+            self._tokens = min(self._tokens + (now - self._last_update) * self._rate, self._burst)
+        self._last_update = now
+
+
+    def consume(self, amount):
+        # blocks until the bucket has enough tokens to cover `amount`
+        with self._lock:
+            if not self._rate:
+                return
+            self._refill()
+            self._tokens -= amount
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0
+        if delay > 0:
+            sleep(delay)
@@ -0,0 +1,146 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+import gzip
+from hashlib import sha1
+import json
+import logging
+import os
+from random import uniform
+import threading
+from time import time
+
+
+class UploadQueue:
+    """
+    A durable on-disk queue of uploads which failed because we couldn't reach the server. Each job is an
+    (endpoint, args, data, update_time) tuple which is stored gzipped and is replaced by any newer job for the same
+    endpoint and args. Jobs are retried with exponential backoff (between `min_retry` and `max_retry` seconds).
+    """
+    def __init__(self, path, min_retry, max_retry):
+        self._path = path
+        self._min_retry = min_retry
+        self._max_retry = max_retry
+        self._lock = threading.Lock()
+        self._jobs = {}
+        if not self._path:
+            return
+        os.makedirs(self._path, exist_ok=True)
+        # load the meta data for the jobs (the data itself is only loaded when it's replayed)
+        for file_name in os.listdir(self._path):
+            if not file_name.endswith(".json.gz"):
+                continue
+            try:
+                job = self._read_job(os.path.join(self._path, file_name))
+            except (OSError, EOFError, ValueError) as e:
+                logging.getLogger().error("Failed to load queued upload ({}): {}".format(file_name, str(e)))
+                continue
+            self._jobs[self._get_key(job['endpoint'], job['args'])] = {k: v for k, v in job.items() if k != 'data'}
+
+
+    def _get_key(self, endpoint, args):
+        return "/".join([endpoint] + [str(x) for x in args])
+
+
+    def _get_file_path(self, key):
+        return os.path.join(self._path, sha1(key.encode("utf8")).hexdigest() + ".json.gz")
+
+
+    def _read_job(self, path):
+        with gzip.open(path, "rt", encoding="utf8") as f:
+            return json.load(f)
+
+
+    def _write_job(self, key, job):
+        path = self._get_file_path(key)
+        with gzip.open(path + ".tmp", "wt", encoding="utf8") as f:
+            json.dump(job, f)
+        os.replace(path + ".tmp", path)
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+
+    def has(self, endpoint, args, update_time=None):
+        # returns whether there's a queued job (with the given update time if one is passed)
+        with self._lock:
+            job = self._jobs.get(self._get_key(endpoint, args))
+        return job is not None and (update_time is None or job['updateTime'] == update_time)
+
+
+    def put(self, endpoint, args, data, update_time):
+        if not self._path:
+            return
+        key = self._get_key(endpoint, args)
+        job = {'endpoint': endpoint, 'args': args, 'data': data, 'updateTime': update_time, 'attempts': 0, 'nextAttempt': time() + self._min_retry}
+        with self._lock:
+            try:
+                self._write_job(key, job)
+            except OSError as e:
+                logging.getLogger().error("Failed to queue upload ({}): {}".format(key, str(e)))
+                return
+            self._jobs[key] = {k: v for k, v in job.items() if k != 'data'}
+
+
+    def get_due(self, max_jobs):
+        # returns up to `max_jobs` jobs which are due to be retried as (endpoint, args, data, update_time) tuples
+        now = time()
+        with self._lock:
+            keys = sorted([k for k, v in self._jobs.items() if v['nextAttempt'] <= now], key=lambda k: self._jobs[k]['nextAttempt'])
+        result = []
+        for key in keys[:max_jobs]:
+            try:
+                job = self._read_job(self._get_file_path(key))
+            except (OSError, EOFError, ValueError) as e:
+                logging.getLogger().error("Failed to load queued upload ({}): {}".format(key, str(e)))
+                self._remove(key)
+                continue
+            result.append((job['endpoint'], job['args'], job['data'], job['updateTime']))
+        return result
+
+
+    def remove(self, endpoint, args):
+        self._remove(self._get_key(endpoint, args))
+
+
+    def _remove(self, key):
+        with self._lock:
+            self._jobs.pop(key, None)
+            try:
+                os.remove(self._get_file_path(key))
+            except OSError:
+                pass
+
+
+    def failed(self, endpoint, args):
+        # schedules the next attempt for a job which failed again
+        key = self._get_key(endpoint, args)
+        with self._lock:
+            if key not in self._jobs:
+                return
+            job = self._jobs[key]
+            job['attempts'] += 1
+            delay = min(self._min_retry * 2 ** job['attempts'], self._max_retry)
+            job['nextAttempt'] = time() + uniform(delay / 2, delay)
+            try:
+                full_job = self._read_job(self._get_file_path(key))
+                full_job.update(job)
+                self._write_job(key, full_job)
+            except (OSError, EOFError, ValueError) as e:
+                logging.getLogger().error("Failed to update queued upload ({}): {}".format(key, str(e)))
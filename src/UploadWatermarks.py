@@ -0,0 +1,85 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+from hashlib import sha1
+import json
+import logging
+import os
+import threading
+from time import time
+
+
+def get_content_hash(data):
+    return sha1(json.dumps(data, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class UploadWatermarks:
+    """
+    Persists what we last successfully uploaded (or found to already be on the server) for each endpoint and key so
+    unchanged data doesn't need to be checked against the server every time. Every `reconcile_interval` seconds, an
+    entry is considered stale so we check with the server again in case it drifted.
+    """
+    def __init__(self, path, reconcile_interval):
+        self._path = path
+        self._reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._entries = {}
+        if self._path and os.path.isfile(self._path):
+            try:
+                with open(self._path, encoding="utf8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.getLogger().error("Failed to load upload watermarks: {}".format(str(e)))
+
+
+    def _get_key(self, endpoint, key):
+        return "\x1f".join([endpoint] + [str(x) for x in key])
+
+
+    def get(self, endpoint, key):
+        # returns the last update time we uploaded if it's not due to be reconciled with the server (otherwise None)
+        with self._lock:
+            entry = self._entries.get(self._get_key(endpoint, key))
+        if not entry or time() - entry['checked'] > self._reconcile_interval:
+            return None
+        return entry['updateTime']
+
+
+    def is_current(self, endpoint, key, update_time, content_hash):
+        # returns whether we've already uploaded exactly this data (and don't need to reconcile it yet)
+        with self._lock:
+            entry = self._entries.get(self._get_key(endpoint, key))
+        if not entry or time() - entry['checked'] > self._reconcile_interval:
+            return False
+        return entry['updateTime'] == update_time and entry['hash'] == content_hash
+
+
+    def set(self, endpoint, key, update_time, content_hash=None):
+        with self._lock:
+            self._entries[self._get_key(endpoint, key)] = {'updateTime': update_time, 'hash': content_hash, 'checked': int(time())}
+            self._save()
+
+
+    def _save(self):
+        if not self._path:
+            return
+        try:
+            with open(self._path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(self._entries, f)
+            os.replace(self._path + ".tmp", self._path)
+        except OSError as e:
+            logging.getLogger().error("Failed to save upload watermarks: {}".format(str(e)))
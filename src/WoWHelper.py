@@ -17,6 +17,7 @@
 # Local modules
 from AppData import AppData
 from Backup import Backup
+from BackupRetention import BackupRetention
 import Config
 from SavedVariables import SavedVariables
 from Settings import load_settings
@@ -28,8 +29,9 @@ from PyQt5.QtCore import pyqtSignal, QFileSystemWatcher, QObject, QStandardPaths
 from datetime import datetime, timedelta
 import logging
 import os
+import psutil
 import re
-from shutil import rmtree
+from shutil import copyfileobj, rmtree
 from time import time
 from zipfile import ZipFile, ZIP_LZMA
 
@@ -53,6 +55,7 @@ class WoWHelper(QObject):
         self._addons = []
         self._settings = load_settings(Config.DEFAULT_SETTINGS)
         self._saved_variables = {}
+        self._app_data = None
         self._temp_backup_path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppDataLocation), Config.TEMP_BACKUP_DIR)
 
         # load the WoW path
@@ -157,6 +160,19 @@ class WoWHelper(QObject):
         return self._valid_wow_path
 
 
+    def is_wow_running(self):
+        # WoW is running if there's a process running from the WoW directory
+        if not self._valid_wow_path:
+            return False
+        for p in psutil.process_iter():
+            try:
+                if p.cwd() == self._settings.wow_path:
+                    return True
+            except:
+                pass
+        return False
+
+
     def get_installed_version(self, addon):
         if self._settings.wow_path == "":
             return self.INVALID_VERSION, 0, ""
@@ -219,8 +235,35 @@ class WoWHelper(QObject):
     def get_app_data(self):
         path = os.path.join(self._get_addon_path("TradeSkillMaster_AppHelper"), "AppData.lua")
         if not os.path.isfile(path):
+            self._app_data = None
             return None
-        return AppData(path)
+        if not self._app_data or self._app_data.get_path() != path or self._app_data.is_stale():
+            self._app_data = AppData(path)
+        return self._app_data
+
+
+    def get_realm_activity(self):
+        # returns the last time we know each realm was played on (from the data the addons saved for it)
+        result = {}
+        def update_activity(realm, timestamp):
+            if isinstance(timestamp, int) and timestamp > result.get(realm, 0):
+                result[realm] = timestamp
+        for account in self.get_accounts():
+            app_helper_data = self._get_saved_variables(account, "TradeSkillMaster_AppHelper")
+            if app_helper_data and isinstance(app_helper_data.get('blackMarket'), dict):
+                for realm, data in app_helper_data['blackMarket'].items():
+                    if isinstance(data, dict):
+                        update_activity(realm, data.get('updateTime'))
+            data = self._get_saved_variables(account, "TradeSkillMaster_Accounting")
+            if not data or '_scopeKeys' not in data or 'realm' not in data['_scopeKeys']:
+                continue
+            for realm in data['_scopeKeys']['realm'].values():
+                for key in ("saveTimeSales", "saveTimeBuys", "saveTimeExpires", "saveTimeCancels"):
+                    save_times = str(data.get("r@{}@{}".format(realm, key), ""))
+                    for save_time in save_times.split(","):
+                        if save_time.isdigit():
+                            update_activity(realm, int(save_time))
+        return result
 
 
     def get_accounting_accounts(self):
@@ -307,14 +350,10 @@ class WoWHelper(QObject):
         backed_up = []
         backups = self.get_backups()
         for account_name in accounts:
-            # delete expired backups first so we'll do a new backup if the most recent one expired
+            # ignore expired backups so we'll do a new backup if the most recent one expired (they get purged later)
             backup_times = []
             for backup in [x for x in backups if x.account == account_name]:
-                path = os.path.join(Config.BACKUP_DIR_PATH, backup.get_local_zip_name())
-                if (datetime.now() - backup.timestamp) > timedelta(seconds=self._settings.backup_expire):
-                    logging.getLogger().info("Purged old backup for account ({}): {}".format(account_name, path))
-                    os.remove(path)
-                else:
+                if (datetime.now() - backup.timestamp) <= timedelta(seconds=self._settings.backup_expire):
                     backup_times.append(backup.timestamp)
 
             # check if the files have changed since the last backup - if not, don't take a new backup
@@ -357,16 +396,80 @@ class WoWHelper(QObject):
         return backups
 
 
-    def restore_backup(self, backup):
+    def purge_backups(self, backups, protected=()):
+        # purge local backups according to the retention policy (except for the ones with their local zip name in
+        # `protected`) and return the ones which were removed
+        local_backups = [x for x in backups if x.is_local]
+        local_zip_names = set(x.get_local_zip_name() for x in local_backups)
+        # everything in the folder counts towards its size budget (with the saved chunk lists going with their backups)
+        sizes = {}
+        other_size = 0
+        try:
+            file_names = os.listdir(Config.BACKUP_DIR_PATH)
+        except OSError:
+            file_names = []
+        for file_name in file_names:
+            try:
+                size = os.path.getsize(os.path.join(Config.BACKUP_DIR_PATH, file_name))
+            except OSError:
+                continue
+            zip_name = file_name[:-len(Config.BACKUP_CHUNK_INDEX_SUFFIX)] if file_name.endswith(Config.BACKUP_CHUNK_INDEX_SUFFIX) else file_name
+            if zip_name in local_zip_names:
+                sizes[zip_name] = sizes.get(zip_name, 0) + size
+            else:
+                other_size += size
+        retention = BackupRetention(Config.BACKUP_RETENTION_TIERS, self._settings.backup_expire, Config.BACKUP_MAX_DIR_SIZE)
+        purged = []
+        for backup in retention.get_purgeable(local_backups, sizes, other_size, protected):
+            path = os.path.join(Config.BACKUP_DIR_PATH, backup.get_local_zip_name())
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.getLogger().error("Failed to purge backup ({}): {}".format(path, str(e)))
+                continue
+            try:
+                # also remove the saved chunk list of the backup (if any)
+                os.remove(path + Config.BACKUP_CHUNK_INDEX_SUFFIX)
+            except OSError:
+                pass
+            logging.getLogger().info("Purged old backup for account ({}): {}".format(backup.account, path))
+            purged.append(backup)
+        return purged
+
+
+    def _get_backup_zip_path(self, backup):
         if backup.is_local:
-            zip_path = os.path.abspath(os.path.join(Config.BACKUP_DIR_PATH, backup.get_local_zip_name()))
+            return os.path.abspath(os.path.join(Config.BACKUP_DIR_PATH, backup.get_local_zip_name()))
         else:
-            zip_path = os.path.abspath(os.path.join(self._temp_backup_path, backup.get_remote_zip_name()))
+            return os.path.abspath(os.path.join(self._temp_backup_path, backup.get_remote_zip_name()))
+
+
+    def get_backup_files(self, backup):
+        # only reads the zip's central directory
+        zip_path = self._get_backup_zip_path(backup)
+        if not os.path.isfile(zip_path):
+            return []
+        with ZipFile(zip_path) as zip:
+            return [x for x in zip.namelist() if x == os.path.basename(x)]
+
+
+    def restore_backup(self, backup, files=None):
+        zip_path = self._get_backup_zip_path(backup)
         if not os.path.isfile(zip_path):
             logging.getLogger().error("Could not find backup: {}".format(zip_path))
             return False
+        sv_path = self._get_saved_variables_path(backup.account)
+        os.makedirs(sv_path, exist_ok=True)
         with ZipFile(zip_path) as zip:
-            zip.extractall(self._get_saved_variables_path(backup.account))
+            for file_name in zip.namelist():
+                if file_name != os.path.basename(file_name) or (files is not None and file_name not in files):
+                    continue
+                # extract to a temporary file first so we never leave a partially-written file behind
+                path = os.path.join(sv_path, file_name)
+                temp_path = path + ".tmp"
+                with zip.open(file_name) as src, open(temp_path, "wb") as dst:
+                    copyfileobj(src, dst)
+                os.replace(temp_path, path)
         logging.getLogger().info("Restored backup ({})".format(str(backup)))
         return True
 
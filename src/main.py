@@ -58,6 +58,12 @@ class TSMApp(QObject):
         Config.LOG_FILE_PATH = os.path.join(app_data_dir, "TSMApplication.log")
         Config.BACKUP_DIR_PATH = os.path.join(app_data_dir, "Backups")
         os.makedirs(Config.BACKUP_DIR_PATH, exist_ok=True)
+        Config.HTTP_CACHE_DIR_PATH = os.path.join(app_data_dir, "HttpCache")
+        Config.UPLOAD_WATERMARKS_PATH = os.path.join(app_data_dir, "UploadWatermarks.json")
+        Config.GROUP_SNAPSHOT_DIR_PATH = os.path.join(app_data_dir, "GroupSnapshots")
+        Config.UPLOAD_QUEUE_DIR_PATH = os.path.join(app_data_dir, "UploadQueue")
+        Config.SESSION_FILE_PATH = os.path.join(app_data_dir, "Session.json")
+        Config.ADDON_CACHE_DIR_PATH = os.path.join(app_data_dir, "AddonCache")
         handler = RotatingFileHandler(Config.LOG_FILE_PATH, mode='w', maxBytes=200000, backupCount=1)
         handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s", "%m/%d/%Y %H:%M:%S"))
         handler.doRollover() # clear the log everytime we start
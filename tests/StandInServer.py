@@ -0,0 +1,122 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# General python modules
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class StandInRequest:
+    # a request which was made to the stand-in server (with the body already de-chunked and gunzipped)
+    def __init__(self, method, path, headers, body, is_chunked):
+        parts = urlsplit(path)
+        self.method = method
+        self.path = parts.path
+        # the path components after the API version (i.e. the endpoint and its arguments)
+        self.args = [unquote(x) for x in parts.path.split("/")[2:]]
+        self.query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.body = body
+        self.is_chunked = is_chunked
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+    def setup(self):
+        super().setup()
+        with self.server.stand_in.lock:
+            self.server.stand_in.connections += 1
+
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    return body, True
+        return self.rfile.read(int(self.headers.get("Content-Length", 0))), False
+
+
+    def _handle(self):
+        stand_in = self.server.stand_in
+        body, is_chunked = self._read_body()
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        request = StandInRequest(self.command, self.path, self.headers, body, is_chunked)
+        with stand_in.lock:
+            stand_in.requests.append(request)
+        response = stand_in.handler(request)
+        if response is None:
+            # close the connection without answering (like a server which went away while handling the request)
+            self.close_connection = True
+            return
+        status, headers, body = response
+        if stand_in.drop_connections:
+            # close the connection without telling the client (like a server which times out idle connections)
+            self.close_connection = True
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        self._handle()
+
+
+    def do_POST(self):
+        self._handle()
+
+
+class StandInServer:
+    """
+    A local HTTP/1.1 server which stands in for the TSM servers in tests. It records the requests it gets and answers
+    them with `handler`, which is called with a StandInRequest and returns a (status, headers, body) tuple (or None to close
+    the connection without answering).
+    """
+    def __init__(self, handler=None):
+        self.handler = handler or (lambda request: (200, {}, b""))
+        self.requests = []
+        self.connections = 0
+        self.drop_connections = False
+        self.lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.stand_in = self
+        self.url = "http://127.0.0.1:{}".format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
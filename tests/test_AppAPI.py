@@ -0,0 +1,393 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from AppAPI import AppAPI, ApiError, ApiTransientError, _JsonDataStream
+from AppData import AppData
+import Config
+from GroupSnapshots import GroupSnapshots
+from StandInServer import StandInServer
+
+# General python modules
+import gzip
+from hashlib import md5
+from io import BytesIO
+import json
+import os
+import re
+import shutil
+import tempfile
+from time import time
+import unittest
+import unittest.mock
+
+
+_DATA = "a\"b\\c/d\n\r\t\b\f é ✓ \U0001F600 {[\"x\"]=1}"
+_RESPONSE = json.dumps({'errorMsg': "", 'data': _DATA, 'time': 1234}, ensure_ascii=True)
+
+
+def _json_response(data):
+    return 200, {'Content-Type': "application/json"}, json.dumps(data).encode("utf8")
+
+
+def _make_api(server, endpoints):
+    # returns an AppAPI which is logged in and sends all its requests to the stand-in server
+    api = AppAPI()
+    api._user_info = {'session': "session", 'userId': 1, 'name': "user", 'isPremium': True, 'endpointSubdomains': {x: "x" for x in endpoints}}
+    api._session_expires = time() + 60 * 60
+    request = api._pool.request
+    api._pool.request = lambda url, *args: request(re.sub(r"^http://[^/]+", server.url, url), *args)
+    return api
+
+
+class JsonDataStreamTest(unittest.TestCase):
+    def _stream(self, pieces):
+        dst = BytesIO()
+        stream = _JsonDataStream(dst)
+        for piece in pieces:
+            stream.feed(piece)
+        return stream, dst.getvalue()
+
+
+    def _check(self, pieces):
+        stream, data = self._stream(pieces)
+        self.assertTrue(stream.is_done())
+        self.assertEqual(data.decode("utf-8"), _DATA)
+        self.assertEqual(json.loads(stream.get_remainder()), {'errorMsg': "", 'data': "", 'time': 1234})
+
+
+    def test_single_piece(self):
+        self._check([_RESPONSE])
+
+
+    def test_split_anywhere(self):
+        # the response may be split at any point, including in the middle of the key or an escape sequence
+        for i in range(len(_RESPONSE) + 1):
+            self._check([_RESPONSE[:i], _RESPONSE[i:]])
+
+
+    def test_single_characters(self):
+        self._check(list(_RESPONSE))
+
+
+    def test_unescaped_unicode(self):
+        response = json.dumps({'data': _DATA}, ensure_ascii=False)
+        for i in range(len(response) + 1):
+            _, data = self._stream([response[:i], response[i:]])
+            self.assertEqual(data.decode("utf-8"), _DATA)
+
+
+    def test_no_data(self):
+        response = json.dumps({'errorMsg': "Invalid session"})
+        stream, data = self._stream([response[:10], response[10:]])
+        self.assertFalse(stream.is_done())
+        self.assertEqual(data, b"")
+        self.assertEqual(json.loads(stream.get_remainder()), {'errorMsg': "Invalid session"})
+
+
+
+class StreamedRealmDataTest(unittest.TestCase):
+    def setUp(self):
+        self._server = StandInServer()
+        self._api = _make_api(self._server, ["auctiondb"])
+
+
+    def tearDown(self):
+        self._api._pool.close()
+        self._server.close()
+
+
+    def test_large_response(self):
+        # the data string is streamed out of a large gzipped response (so escapes are split across reads)
+        data = "".join("[\"i:{}\"]={{\"\\n\u00e9\"}},".format(i) for i in range(100000))
+        body = gzip.compress(json.dumps({'success': True, 'data': data}).encode("utf8"))
+        self._server.handler = lambda request: (200, {'Content-Type': "application/json", 'Content-Encoding': "gzip"}, body)
+        dst = BytesIO()
+        self.assertFalse(self._api.auctiondb("realm", "1", dst=dst))
+        self.assertEqual(dst.getvalue().decode("utf8"), data)
+
+
+    def test_error(self):
+        self._server.handler = lambda request: _json_response({'success': False, 'error': "Invalid realm"})
+        with self.assertRaises(ApiError):
+            self._api.auctiondb("realm", "1", dst=BytesIO())
+
+
+    def test_missing_data(self):
+        self._server.handler = lambda request: _json_response({'success': True})
+        with self.assertLogs(level="ERROR"), self.assertRaises(ApiTransientError):
+            self._api.auctiondb("realm", "1", dst=BytesIO())
+
+
+class PatchRealmDataTest(unittest.TestCase):
+    def setUp(self):
+        self._server = StandInServer()
+        self._api = _make_api(self._server, ["auctiondb", "auctiondb_patch"])
+        self._dir = tempfile.mkdtemp()
+        self._app_data = AppData(os.path.join(self._dir, "AppData.lua"))
+        self._app_data.update("AUCTIONDB_MARKET_DATA", "Realm", "{1,2,3}", 100)
+        self._app_data.save()
+
+
+    def tearDown(self):
+        self._api._pool.close()
+        self._server.close()
+        shutil.rmtree(self._dir)
+
+
+    def test_patch(self):
+        patch = {'success': True, 'ops': [[0, 6], ",4}"], 'md5': md5(b"{1,2,3,4}").hexdigest()}
+        self._server.handler = lambda request: _json_response(patch)
+        patch = self._api.auctiondb_patch("realm", "1", 100)
+        # the patch is requested from the version we have
+        self.assertEqual(self._server.requests[0].args, ["auctiondb_patch", "realm", "1", "100"])
+        payload = self._app_data.apply_patch("AUCTIONDB_MARKET_DATA", "Realm", patch['ops'], patch['md5'])
+        self._app_data.update_from_payload("AUCTIONDB_MARKET_DATA", "Realm", payload, 200)
+        self._app_data.save()
+        with open(self._app_data.get_path(), encoding="utf8") as f:
+            self.assertIn("=[[return {1,2,3,4}]] --<SHARED,", f.read())
+
+
+    def test_no_patch(self):
+        # the server can't always provide a patch (i.e. if our version is too old), so the data is downloaded instead
+        self._server.handler = lambda request: _json_response({'success': False, 'error': "No patch available"})
+        with self.assertRaises(ApiError):
+            self._api.auctiondb_patch("realm", "1", 100)
+
+
+class UploadBatchTest(unittest.TestCase):
+    _ENDPOINTS = ("batch", "black_market", "wow_token", "sales", "sales_compact", "groups", "groups_diff", "analytics")
+
+    def setUp(self):
+        self._server = StandInServer(self._handle)
+        self._batch_results = None
+        self._dir = tempfile.mkdtemp()
+        self._api = _make_api(self._server, self._ENDPOINTS)
+        self._api._group_snapshots = GroupSnapshots(self._dir)
+
+
+    def tearDown(self):
+        self._api._pool.close()
+        self._server.close()
+        shutil.rmtree(self._dir)
+
+
+    def _handle(self, request):
+        endpoint = request.args[0]
+        if endpoint == "batch":
+            items = json.loads(request.body.decode("utf8"))
+            if self._batch_results is not None:
+                return _json_response({'success': True, 'results': self._batch_results})
+            return _json_response({'success': True, 'results': [{'uploaded': True} for _ in items]})
+        elif request.method == "GET":
+            return _json_response({'success': True, 'lastUpload': 0, 'lastUpdate': 0})
+        elif endpoint == "groups_diff":
+            return _json_response({'success': True, 'applied': True})
+        return _json_response({'success': True})
+
+
+    def _get_requests(self):
+        return [(x.method, x.args[0]) for x in self._server.requests]
+
+
+    def _get_batch_items(self):
+        return [json.loads(x.body.decode("utf8")) for x in self._server.requests if x.args[0] == "batch"]
+
+
+    def test_batch(self):
+        uploads = [
+            ("black_market", ["US", "Realm"], {'items': [1]}, 100),
+            ("wow_token", ["US"], {'price': 1}, 100),
+            ("sales", ["US", "Realm", "Account"], [[1, 2, 3, 4, 5, 6, "Auction"]], 100),
+            ("groups", ["Account", "Default"], {'data': {}, 'profiles': [], 'updateTime': 100}, 100),
+            ("analytics", ["Account"], {'data': 1}, 100),
+        ]
+        self.assertEqual(self._api.upload_batch(uploads), [(True, None)] * len(uploads))
+        # everything is sent in a single request (with sales in the compact format)
+        self.assertEqual(self._get_requests(), [("POST", "batch")])
+        items = self._get_batch_items()[0]
+        self.assertEqual([x['endpoint'] for x in items], ["black_market", "wow_token", "sales_compact", "groups", "analytics"])
+        self.assertEqual(items[0]['args'], ["US", "UmVhbG0="])
+        self.assertEqual(items[2]['data']['counts'], [1])
+        # the watermarks were set, so the same data isn't sent again (other than sales, which are only ever new data)
+        self._server.requests = []
+        self.assertEqual(self._api.upload_batch(uploads[:2] + uploads[3:]), [(False, None)] * 4)
+        self.assertEqual(self._server.requests, [])
+
+
+    def test_no_batch_endpoint(self):
+        api = _make_api(self._server, [x for x in self._ENDPOINTS if x != "batch"])
+        uploads = [("black_market", ["US", "Realm"], {'items': [1]}, 100), ("wow_token", ["US"], {'price': 1}, 100)]
+        self.assertEqual(api.upload_batch(uploads), [(True, None), (True, None)])
+        api._pool.close()
+        # each upload checks the last upload time and then uploads the data separately
+        self.assertEqual(sorted(self._get_requests()), [("GET", "black_market"), ("GET", "wow_token"), ("POST", "black_market"), ("POST", "wow_token")])
+
+
+    def test_item_errors(self):
+        self._batch_results = [{'error': "Invalid data"}, {'uploaded': False}]
+        uploads = [("black_market", ["US", "Realm"], {'items': [1]}, 100), ("wow_token", ["US"], {'price': 1}, 100)]
+        results = self._api.upload_batch(uploads)
+        self.assertIsInstance(results[0][1], ApiError)
+        self.assertEqual(str(results[0][1]), "Invalid data")
+        self.assertEqual(results[1], (False, None))
+        # only the item which succeeded has its watermark set
+        self._server.requests = []
+        self._batch_results = None
+        self._api.upload_batch(uploads)
+        self.assertEqual([x['endpoint'] for x in self._get_batch_items()[0]], ["black_market"])
+
+
+    def test_result_count_mismatch(self):
+        self._batch_results = [{'uploaded': True}]
+        uploads = [("black_market", ["US", "Realm"], {'items': [1]}, 100), ("wow_token", ["US"], {'price': 1}, 100)]
+        with self.assertLogs(level="ERROR"):
+            results = self._api.upload_batch(uploads)
+        self.assertTrue(all(result is None and isinstance(error, ApiTransientError) for result, error in results))
+        # none of the watermarks were set, so both are sent again
+        self._server.requests = []
+        self._batch_results = None
+        self._api.upload_batch(uploads)
+        self.assertEqual(len(self._get_batch_items()[0]), 2)
+
+
+    def test_request_failure(self):
+        self._server.handler = lambda request: (503, {}, b"")
+        with self.assertLogs(level="ERROR"):
+            results = self._api.upload_batch([("wow_token", ["US"], {'price': 1}, 100)])
+        self.assertIsInstance(results[0][1], ApiTransientError)
+
+
+    def test_separate_uploads(self):
+        groups = {'data': {'Group A': {'items': ["i:1"]}}, 'profiles': ["Default"], 'updateTime': 100}
+        self._api.upload_batch([("groups", ["Account", "Default"], groups, 100)])
+        self._server.requests = []
+        # large sales histories are uploaded in chunks and groups which we have a snapshot of are uploaded as a diff
+        sales = [[1, 2, 3, 4, 5, 6 + i, "Auction"] for i in range(5)]
+        new_groups = {'data': {'Group A': {'items': ["i:1", "i:2"]}}, 'profiles': ["Default"], 'updateTime': 200}
+        uploads = [("sales", ["US", "Realm", "Account"], sales, 100), ("groups", ["Account", "Default"], new_groups, 200), ("wow_token", ["US"], {'price': 1}, 100)]
+        with unittest.mock.patch.object(Config, "SALES_UPLOAD_MAX_ROWS", 2):
+            self.assertEqual(self._api.upload_batch(uploads), [(True, None)] * 3)
+        requests = self._get_requests()
+        self.assertEqual(requests.count(("POST", "sales_compact")), 3)
+        self.assertIn(("POST", "groups_diff"), requests)
+        self.assertNotIn(("POST", "groups"), requests)
+        self.assertEqual([x['endpoint'] for x in self._get_batch_items()[0]], ["wow_token"])
+
+
+
+class SalesUploadTest(unittest.TestCase):
+    def setUp(self):
+        self._server = StandInServer(self._handle)
+        self._fail_after = None
+        self._api = _make_api(self._server, ["sales", "sales_compact"])
+
+
+    def tearDown(self):
+        self._api._pool.close()
+        self._server.close()
+
+
+    def _handle(self, request):
+        if request.method == "GET":
+            return _json_response({'success': True, 'lastUpload': 5})
+        if self._fail_after is not None and len([x for x in self._server.requests if x.method == "POST"]) > self._fail_after:
+            return 503, {}, b""
+        return _json_response({'success': True})
+
+
+    def test_chunks(self):
+        sales = [[1, 2, 3, 4, 5, save_time, "Auction"] for save_time in (12, 10, 11, 10, 13)]
+        with unittest.mock.patch.object(Config, "SALES_UPLOAD_MAX_ROWS", 2):
+            self.assertTrue(self._api.sales("US", "Realm", "Account", sales, 20))
+        # the chunks are uploaded oldest first and rows with the same save time are kept together
+        chunks = [json.loads(x.body.decode("utf8")) for x in self._server.requests]
+        self.assertEqual([x['counts'] for x in chunks], [[2], [2], [1]])
+        self.assertEqual([x['saveTimes'] for x in chunks], [[10], [11, 1], [13]])
+        # the last upload time is known locally after uploading
+        self.assertEqual(self._api.sales("US", "Realm", "Account"), 20)
+        self.assertEqual(len(self._server.requests), 3)
+
+
+    def test_resume(self):
+        sales = [[1, 2, 3, 4, 5, save_time, "Auction"] for save_time in (10, 11, 12, 13)]
+        self._fail_after = 2
+        with unittest.mock.patch.object(Config, "SALES_UPLOAD_MAX_ROWS", 1), self.assertLogs(level="ERROR"):
+            with self.assertRaises(ApiTransientError):
+                self._api.sales("US", "Realm", "Account", sales, 20)
+        # the last upload time is that of the last chunk which made it, so only the rest will be uploaded next time
+        self.assertEqual(self._api.sales("US", "Realm", "Account"), 11)
+
+
+
+class RawRealmDataTest(unittest.TestCase):
+    def setUp(self):
+        self._server = StandInServer()
+        self._api = _make_api(self._server, ["auctiondb", "shopping"])
+        self._dir = tempfile.mkdtemp()
+        self._app_data = AppData(os.path.join(self._dir, "AppData.lua"))
+
+
+    def tearDown(self):
+        self._api._pool.close()
+        self._server.close()
+        shutil.rmtree(self._dir)
+
+
+    def _download(self, *args):
+        # downloads the data into a payload the same way MainThread does and returns the saved entry
+        type = "SHOPPING_SEARCHES" if args[0] == "shopping" else "AUCTIONDB_MARKET_DATA"
+        with self._app_data.new_payload() as payload:
+            payload.store_raw = getattr(self._api, args[0])(*args[1:], dst=payload)
+        self._app_data.update_from_payload(type, "Realm", payload, 100)
+        self._app_data.save()
+        with open(self._app_data.get_path(), encoding="utf8") as f:
+            return payload.store_raw, f.read()
+
+
+    def test_raw(self):
+        self._server.handler = lambda request: (200, {'Content-Type': "application/octet-stream"}, b"return {1,2}")
+        store_raw, saved = self._download("auctiondb", "realm", "1")
+        # the compact format is preferred, but JSON is still accepted
+        self.assertEqual(self._server.requests[0].headers['Accept'], "application/octet-stream, application/json;q=0.9")
+        self.assertTrue(store_raw)
+        self.assertIn("=return {1,2} --<SHARED,", saved)
+
+
+    def test_raw_gzipped(self):
+        self._server.handler = lambda request: (200, {'Content-Type': "application/octet-stream", 'Content-Encoding': "gzip"}, gzip.compress(b"return {3}"))
+        store_raw, saved = self._download("shopping", "1")
+        self.assertTrue(store_raw)
+        self.assertIn("=return {3} --<SHARED,", saved)
+
+
+    def test_json(self):
+        # servers which don't support the compact format still send the data as a JSON string
+        self._server.handler = lambda request: _json_response({'success': True, 'data': "{\"a\"}"})
+        store_raw, saved = self._download("auctiondb", "realm", "1")
+        self.assertFalse(store_raw)
+        self.assertIn("=[[return {\"a\"}]] --<SHARED,", saved)
+
+
+    def test_not_streamed(self):
+        # the compact format is only requested when the data is streamed into a payload
+        self._server.handler = lambda request: _json_response({'success': True, 'data': "{}"})
+        self.assertEqual(self._api.shopping("1"), {'data': "{}"})
+        self.assertNotIn('Accept', self._server.requests[0].headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
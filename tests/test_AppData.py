@@ -0,0 +1,159 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from AppData import AppData
+
+# General python modules
+from hashlib import md5
+import os
+import shutil
+import tempfile
+import unittest
+
+
+_MARKET_DATA = "AUCTIONDB_MARKET_DATA"
+
+
+def _get_checksum(data):
+    return md5(data.encode("utf8")).hexdigest()
+
+
+class AppDataTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, "AppData.lua")
+
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+
+    def _get_value(self, app_data, type, realm):
+        # returns the stored value and whether it's stored raw
+        offset, length, store_raw = app_data._get_data_range(type, realm)
+        with open(self._path, "rb") as f:
+            f.seek(offset)
+            return f.read(length).decode("utf8"), store_raw
+
+
+    def _update_from_payload(self, app_data, type, realm, data, time, store_raw=False):
+        with app_data.new_payload() as payload:
+            payload.store_raw = store_raw
+            payload.write(data.encode("utf8"))
+        app_data.update_from_payload(type, realm, payload, time)
+
+
+    def test_save_and_load(self):
+        app_data = AppData(self._path)
+        app_data.update(_MARKET_DATA, "Realm-A", "{1,2,3}", 100)
+        app_data.update(_MARKET_DATA, "Realm-B", "{1,2,3}", 101)
+        self._update_from_payload(app_data, _MARKET_DATA, "Realm-C", "{4,5,6}", 102)
+        app_data.update("APP_INFO", "Global", "{version=1}", 103)
+        app_data.save()
+        app_data = AppData(self._path)
+        self.assertEqual(app_data.last_update(_MARKET_DATA, "Realm-A"), 100)
+        self.assertEqual(app_data.last_update(_MARKET_DATA, "Realm-C"), 102)
+        self.assertEqual(app_data.last_update("APP_INFO", "Global"), 103)
+        self.assertEqual(self._get_value(app_data, _MARKET_DATA, "Realm-A"), ("{1,2,3}", False))
+        self.assertEqual(self._get_value(app_data, _MARKET_DATA, "Realm-C"), ("{4,5,6}", False))
+        # identical data is only stored once
+        with open(self._path, encoding="utf8") as f:
+            self.assertEqual(f.read().count("{1,2,3}"), 1)
+
+
+    def test_patch_round_trip(self):
+        app_data = AppData(self._path)
+        self._update_from_payload(app_data, _MARKET_DATA, "Realm-A", "{1,2,3,4,5}", 100)
+        app_data.update(_MARKET_DATA, "Realm-B", "{7,8,9}", 100)
+        app_data.save()
+        ops = [[0, 5], "9,", [5, 6]]
+        payload = app_data.apply_patch(_MARKET_DATA, "Realm-A", ops, _get_checksum("{1,2,9,3,4,5}"))
+        self.assertIsNotNone(payload)
+        app_data.update_from_payload(_MARKET_DATA, "Realm-A", payload, 200)
+        app_data.save()
+        self.assertTrue(payload.is_closed())
+        # the patched data is saved and the other entries are kept as-is
+        for app_data in (app_data, AppData(self._path)):
+            self.assertEqual(app_data.last_update(_MARKET_DATA, "Realm-A"), 200)
+            self.assertEqual(self._get_value(app_data, _MARKET_DATA, "Realm-A"), ("{1,2,9,3,4,5}", False))
+            self.assertEqual(self._get_value(app_data, _MARKET_DATA, "Realm-B"), ("{7,8,9}", False))
+
+
+    def test_patch_raw(self):
+        app_data = AppData(self._path)
+        self._update_from_payload(app_data, _MARKET_DATA, "Realm-A", "return {1,2,3}", 100, store_raw=True)
+        app_data.save()
+        payload = app_data.apply_patch(_MARKET_DATA, "Realm-A", [[0, 13], ",4}"], _get_checksum("return {1,2,3,4}"))
+        app_data.update_from_payload(_MARKET_DATA, "Realm-A", payload, 200)
+        app_data.save()
+        self.assertEqual(self._get_value(AppData(self._path), _MARKET_DATA, "Realm-A"), ("return {1,2,3,4}", True))
+
+
+    def test_patch_failures(self):
+        app_data = AppData(self._path)
+        app_data.update(_MARKET_DATA, "Realm-A", "{1,2,3}", 100)
+        # the data hasn't been saved yet
+        self.assertIsNone(app_data.apply_patch(_MARKET_DATA, "Realm-A", [[0, 7]], _get_checksum("{1,2,3}")))
+        app_data.save()
+        app_data.apply_patch(_MARKET_DATA, "Realm-A", [[0, 7]], _get_checksum("{1,2,3}")).close()
+        # unknown entry, out of range copy, invalid op and checksum mismatch
+        self.assertIsNone(app_data.apply_patch(_MARKET_DATA, "Realm-B", [[0, 7]], _get_checksum("{1,2,3}")))
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(app_data.apply_patch(_MARKET_DATA, "Realm-A", [[1, 7]], _get_checksum("1,2,3}")))
+            self.assertIsNone(app_data.apply_patch(_MARKET_DATA, "Realm-A", [5], _get_checksum("")))
+            self.assertIsNone(app_data.apply_patch(_MARKET_DATA, "Realm-A", [[0, 7]], _get_checksum("{1,2,4}")))
+        # a failed patch doesn't change the stored data
+        app_data.save()
+        self.assertEqual(self._get_value(AppData(self._path), _MARKET_DATA, "Realm-A"), ("{1,2,3}", False))
+
+
+    def test_save_keeps_unsaved_payloads(self):
+        app_data = AppData(self._path)
+        self._update_from_payload(app_data, _MARKET_DATA, "Realm-A", "{1}", 100)
+        pending = app_data.new_payload()
+        app_data.save(close_payloads=False)
+        # payloads which are still being written aren't closed by saves in the middle of a cycle
+        self.assertFalse(pending.is_closed())
+        app_data.update(_MARKET_DATA, "Realm-B", "{2}", 100)
+        app_data.save()
+        self.assertTrue(pending.is_closed())
+
+
+    def test_save_after_replaced(self):
+        app_data = AppData(self._path)
+        app_data.update(_MARKET_DATA, "Realm-A", "{1}", 100)
+        app_data.update(_MARKET_DATA, "Realm-B", "{2}", 100)
+        app_data.save()
+        app_data.update(_MARKET_DATA, "Realm-B", "{3}", 101)
+        # the file is replaced (i.e. by reinstalling the addon) before we save our changes
+        other_app_data = AppData(os.path.join(self._dir, "Other.lua"))
+        other_app_data.update(_MARKET_DATA, "Realm-C", "{4,5,6,7,8,9}", 102)
+        other_app_data.save()
+        os.replace(other_app_data.get_path(), self._path)
+        self.assertTrue(app_data.is_stale())
+        with self.assertLogs(level="WARNING"):
+            app_data.save()
+        self.assertFalse(app_data.is_stale())
+        # our changes are kept on top of the new file, and nothing is copied from where the old one had its data
+        app_data = AppData(self._path)
+        self.assertEqual(app_data.last_update(_MARKET_DATA, "Realm-A"), 0)
+        self.assertEqual(self._get_value(app_data, _MARKET_DATA, "Realm-B"), ("{3}", False))
+        self.assertEqual(self._get_value(app_data, _MARKET_DATA, "Realm-C"), ("{4,5,6,7,8,9}", False))
+
+
+if __name__ == "__main__":
+    unittest.main()
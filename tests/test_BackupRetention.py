@@ -0,0 +1,77 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from Backup import Backup
+from BackupRetention import BackupRetention
+
+# General python modules
+import unittest
+
+
+_DAY = 24 * 60 * 60
+_NOW = 100 * _DAY
+
+
+def _make_backup(account, timestamp, keep=False):
+    return Backup(system_id="SYSTEM", account=account, raw_timestamp=timestamp, keep=keep, is_local=True, is_remote=False)
+
+
+class BackupRetentionTest(unittest.TestCase):
+    def _get_purgeable(self, backups, max_size, other_size=0, protected=()):
+        # every backup is 10 bytes and they're all kept by the tiers, so only the size budget purges them
+        retention = BackupRetention([(None, 0)], 365 * _DAY, max_size)
+        sizes = {x.get_local_zip_name(): 10 for x in backups}
+        return retention.get_purgeable(backups, sizes, other_size, protected, _NOW)
+
+
+    def test_tiers(self):
+        backups = [_make_backup("A", _NOW - 60), _make_backup("A", _NOW - 120), _make_backup("A", 97 * _DAY + 20),
+                   _make_backup("A", 97 * _DAY + 10), _make_backup("A", 60 * _DAY, True), _make_backup("A", 60 * _DAY + 10)]
+        retention = BackupRetention([(_DAY, 0), (None, _DAY)], 30 * _DAY, 1000)
+        purged = retention.get_purgeable(backups, {}, now=_NOW)
+        # only the most recent backup of each older day is kept, and ones which are too old are purged unless flagged
+        self.assertEqual(purged, [backups[3], backups[5]])
+
+
+    def test_size(self):
+        backups = [_make_backup("A", _NOW - 3 * _DAY), _make_backup("A", _NOW - 2 * _DAY), _make_backup("A", _NOW - _DAY)]
+        self.assertEqual(self._get_purgeable(backups, 30), [])
+        # the oldest backups are purged first, but the latest one is always kept
+        self.assertEqual(self._get_purgeable(backups, 20), [backups[0]])
+        self.assertEqual(self._get_purgeable(backups, 0), [backups[0], backups[1]])
+
+
+    def test_size_counts_everything(self):
+        backups = [_make_backup("A", _NOW - 3 * _DAY, True), _make_backup("A", _NOW - 2 * _DAY), _make_backup("A", _NOW - _DAY),
+                   _make_backup("B", _NOW - 2 * _DAY)]
+        # backups which are never purged still use up the budget
+        self.assertEqual(self._get_purgeable(backups, 35), [backups[1]])
+        # as does everything else in the folder
+        self.assertEqual(self._get_purgeable(backups, 45), [])
+        self.assertEqual(self._get_purgeable(backups, 45, 10), [backups[1]])
+
+
+    def test_protected(self):
+        backups = [_make_backup("A", _NOW - 3 * _DAY), _make_backup("A", _NOW - 2 * _DAY), _make_backup("A", _NOW - _DAY)]
+        # the next oldest backup is purged instead of one which can't be purged right now
+        self.assertEqual(self._get_purgeable(backups, 20, protected=[backups[0].get_local_zip_name()]), [backups[1]])
+        retention = BackupRetention([(None, 0)], _DAY, 1000)
+        self.assertEqual(retention.get_purgeable(backups, {}, protected=[backups[0].get_local_zip_name()], now=_NOW), [backups[1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,229 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from AppAPI import ApiError
+from BackupSync import BackupSync, get_chunk_hash, iter_chunks
+
+# General python modules
+from io import BytesIO
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+import unittest.mock
+from zipfile import ZipFile, ZIP_LZMA
+import zlib
+
+
+class _SmallReads(BytesIO):
+    # returns short reads like a file which is still being written or a socket would
+    def read(self, size=-1):
+        return super().read(min(size, 1000) if size >= 0 else 1000)
+
+
+class _FakeBackupAPI:
+    def __init__(self):
+        self.chunks = {}
+        self.manifests = {}
+        self.zips = {}
+        self.uploaded = 0
+        self.downloaded = 0
+
+
+    def has_endpoint(self, endpoint):
+        return True
+
+
+    def backup_chunks(self, hashes):
+        return [x for x in hashes if x not in self.chunks]
+
+
+    def backup_chunk(self, chunk_hash, data=None):
+        if data:
+            self.chunks[chunk_hash] = data
+            self.uploaded += 1
+        else:
+            self.downloaded += 1
+            return self.chunks[chunk_hash]
+
+
+    def backup_manifest(self, name, manifest=None):
+        if manifest:
+            self.manifests[name] = manifest
+        elif name not in self.manifests:
+            raise ApiError("Backup manifest not found")
+        else:
+            return self.manifests[name]
+
+
+    def backup(self, name, dst):
+        dst.write(self.zips[name])
+        return True
+
+
+def _get_lines(seed, count):
+    rand = random.Random(seed)
+    return ["[\"i:{}\"] = {{{}, {}}},\n".format(i, rand.randint(0, 10 ** 6), rand.random()) for i in range(count)]
+
+
+class IterChunksTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(list(iter_chunks(BytesIO(b""))), [])
+
+
+    def test_small(self):
+        self.assertEqual(list(iter_chunks(BytesIO(b"abc"))), [b"abc"])
+
+
+    def test_sizes(self):
+        data = random.Random(1).getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, "little")
+        chunks = list(iter_chunks(BytesIO(data)))
+        self.assertEqual(b"".join(chunks), data)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 2 * 1024)
+            self.assertLessEqual(len(chunk), 64 * 1024)
+
+
+    def test_max_size(self):
+        # there are no boundaries in data which doesn't change, so it's split at the max size
+        chunks = list(iter_chunks(BytesIO(b"\0" * 200 * 1024)))
+        self.assertEqual([len(x) for x in chunks], [64 * 1024] * 3 + [8 * 1024])
+
+
+    def test_short_reads(self):
+        data = "".join(_get_lines(1, 10000)).encode("utf8")
+        self.assertEqual(list(iter_chunks(_SmallReads(data))), list(iter_chunks(BytesIO(data))))
+
+
+    def test_insertion(self):
+        # an insertion should only change the chunks around it
+        lines = _get_lines(1, 20000)
+        old_chunks = list(iter_chunks(BytesIO("".join(lines).encode("utf8"))))
+        lines.insert(10000, "[\"i:new\"] = {1, 2},\n")
+        new_chunks = list(iter_chunks(BytesIO("".join(lines).encode("utf8"))))
+        changed = set(new_chunks) - set(old_chunks)
+        self.assertLessEqual(len(changed), 2)
+        self.assertLess(sum(len(x) for x in changed), 3 * 64 * 1024)
+
+
+class BackupSyncTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._api = _FakeBackupAPI()
+        self._sync = BackupSync(self._api)
+
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+
+    def _write_backup(self, name, files):
+        path = os.path.join(self._dir, name)
+        with ZipFile(path, "w", ZIP_LZMA) as zip_file:
+            for file_name, data in sorted(files.items()):
+                zip_file.writestr(file_name, data)
+        return path
+
+
+    def _download(self, name, local_paths):
+        dst = BytesIO()
+        self._sync.download(name, dst, local_paths)
+        with ZipFile(BytesIO(dst.getvalue())) as zip_file:
+            return {x: zip_file.read(x) for x in zip_file.namelist()}
+
+
+    def test_round_trip(self):
+        files = {'A.lua': "".join(_get_lines(1, 5000)).encode("utf8"), 'B.lua': b"x = 1\n", 'C.lua': b""}
+        path = self._write_backup("a_1.zip", files)
+        self._sync.upload("r1", path)
+        self.assertEqual(set(self._api.chunks), set(x[0] for f in self._api.manifests["r1"]['files'] for x in f['chunks']))
+        for chunk_hash, data in self._api.chunks.items():
+            self.assertEqual(get_chunk_hash(zlib.decompress(data)), chunk_hash)
+        self.assertEqual(self._download("r1", []), files)
+
+
+    def test_incremental(self):
+        lines = _get_lines(1, 20000)
+        path1 = self._write_backup("a_1.zip", {'A.lua': "".join(lines), 'B.lua': "".join(_get_lines(2, 5000))})
+        self._sync.upload("r1", path1)
+        uploaded = self._api.uploaded
+        lines[10000] = "[\"i:changed\"] = {1, 2},\n"
+        files2 = {'A.lua': "".join(lines).encode("utf8"), 'B.lua': "".join(_get_lines(2, 5000)).encode("utf8")}
+        path2 = self._write_backup("a_2.zip", files2)
+        self._sync.upload("r2", path2, [path1])
+        # only the chunks around the change are uploaded
+        self.assertLessEqual(self._api.uploaded - uploaded, 2)
+        # restoring it only downloads the chunks which aren't in the local backup
+        self._api.downloaded = 0
+        self.assertEqual(self._download("r2", [path1]), files2)
+        self.assertLessEqual(self._api.downloaded, 2)
+
+
+    def test_unchanged_files_reuse_index(self):
+        files = {'A.lua': "".join(_get_lines(1, 5000))}
+        path1 = self._write_backup("a_1.zip", files)
+        self._sync.upload("r1", path1)
+        path2 = self._write_backup("a_2.zip", files)
+        # unchanged files use the chunk list saved for the previous backup rather than being chunked again
+        with unittest.mock.patch("BackupSync.iter_chunks", side_effect=AssertionError):
+            self._sync.upload("r2", path2, [path1])
+        self.assertEqual(self._api.manifests["r2"], self._api.manifests["r1"])
+
+
+    def test_local_chunk_mismatch(self):
+        files = {'A.lua': "".join(_get_lines(1, 5000)).encode("utf8")}
+        path = self._write_backup("a_1.zip", files)
+        self._sync.upload("r1", path)
+        # the local backup no longer matches its saved chunk list, so the chunks are downloaded instead
+        self._write_backup("a_1.zip", {'A.lua': b"changed"})
+        self.assertEqual(self._download("r1", [path]), files)
+        self.assertEqual(self._api.downloaded, len(self._api.chunks))
+
+
+    def test_reordered_local_chunks(self):
+        # the local chunks are needed out of order, so the local file has to be read again from the start
+        lines = _get_lines(1, 20000)
+        path1 = self._write_backup("a_1.zip", {'A.lua': "".join(lines)})
+        self._sync.upload("r1", path1)
+        files2 = {'A.lua': "".join(lines[10000:] + lines[:10000]).encode("utf8")}
+        path2 = self._write_backup("a_2.zip", files2)
+        self._sync.upload("r2", path2, [path1])
+        self._api.downloaded = 0
+        self.assertEqual(self._download("r2", [path1]), files2)
+        self.assertLessEqual(self._api.downloaded, 3)
+
+
+    def test_old_python_zip_writes(self):
+        # before python 3.6, files are written to the zip via a temporary file
+        files = {'A.lua': "".join(_get_lines(1, 5000)).encode("utf8"), 'B.lua': b""}
+        self._sync.upload("r1", self._write_backup("a_1.zip", files))
+        with unittest.mock.patch.object(sys, "version_info", (3, 4, 3)):
+            self.assertEqual(self._download("r1", []), files)
+
+
+    def test_no_manifest(self):
+        # backups which were uploaded as whole zips are downloaded that way
+        with open(self._write_backup("a_1.zip", {'A.lua': b"x = 1\n"}), "rb") as f:
+            self._api.zips["r1"] = f.read()
+        self.assertEqual(self._download("r1", []), {'A.lua': b"x = 1\n"})
+
+
+if __name__ == "__main__":
+    unittest.main()
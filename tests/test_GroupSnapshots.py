@@ -0,0 +1,112 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from GroupSnapshots import GroupSnapshots, get_groups_diff
+from UploadWatermarks import get_content_hash
+
+# General python modules
+import copy
+import shutil
+import tempfile
+import unittest
+
+
+_OLD_GROUPS = {
+    'updateTime': 100,
+    'profiles': ["Default"],
+    'data': {'Group A': {'items': ["i:1", "i:2"]}, 'Group B': {'items': ["i:3"]}, 'Group C': {'items': []}},
+}
+
+
+def _apply_groups_diff(old, diff):
+    # applies the diff the way the server does
+    assert(diff['base'] == get_content_hash(old))
+    data = {k: v for k, v in old['data'].items() if k not in diff['removed']}
+    data.update(diff['added'])
+    data.update(diff['changed'])
+    return {'updateTime': diff['updateTime'], 'profiles': diff['profiles'], 'data': data}
+
+
+class GetGroupsDiffTest(unittest.TestCase):
+    def test_diff(self):
+        new = copy.deepcopy(_OLD_GROUPS)
+        new['updateTime'] = 200
+        new['data']['Group A']['items'].append("i:4")
+        del new['data']['Group B']
+        new['data']['Group D'] = {'items': ["i:5"]}
+        diff = get_groups_diff(_OLD_GROUPS, new)
+        self.assertEqual(diff['base'], get_content_hash(_OLD_GROUPS))
+        self.assertEqual(diff['updateTime'], 200)
+        self.assertEqual(diff['added'], {'Group D': {'items': ["i:5"]}})
+        self.assertEqual(diff['changed'], {'Group A': {'items': ["i:1", "i:2", "i:4"]}})
+        self.assertEqual(diff['removed'], ["Group B"])
+        self.assertEqual(_apply_groups_diff(_OLD_GROUPS, diff), new)
+
+
+    def test_no_changes(self):
+        diff = get_groups_diff(_OLD_GROUPS, copy.deepcopy(_OLD_GROUPS))
+        self.assertEqual((diff['added'], diff['changed'], diff['removed']), ({}, {}, []))
+        self.assertEqual(_apply_groups_diff(_OLD_GROUPS, diff), _OLD_GROUPS)
+
+
+    def test_profiles(self):
+        new = copy.deepcopy(_OLD_GROUPS)
+        new['profiles'] = ["Default", "Alt"]
+        self.assertEqual(_apply_groups_diff(_OLD_GROUPS, get_groups_diff(_OLD_GROUPS, new)), new)
+
+
+    def test_everything_replaced(self):
+        new = {'updateTime': 300, 'profiles': [], 'data': {'Group E': {'items': ["i:6"]}}}
+        diff = get_groups_diff(_OLD_GROUPS, new)
+        self.assertEqual(sorted(diff['removed']), ["Group A", "Group B", "Group C"])
+        self.assertEqual(_apply_groups_diff(_OLD_GROUPS, diff), new)
+
+
+    def test_base_hash(self):
+        # the base hash doesn't depend on the order of the keys but does depend on the contents
+        reordered = {'data': dict(reversed(list(_OLD_GROUPS['data'].items()))), 'profiles': ["Default"], 'updateTime': 100}
+        self.assertEqual(get_groups_diff(reordered, _OLD_GROUPS)['base'], get_groups_diff(_OLD_GROUPS, _OLD_GROUPS)['base'])
+        changed = copy.deepcopy(_OLD_GROUPS)
+        changed['data']['Group C']['items'].append("i:7")
+        self.assertNotEqual(get_groups_diff(changed, _OLD_GROUPS)['base'], get_groups_diff(_OLD_GROUPS, _OLD_GROUPS)['base'])
+
+
+class GroupSnapshotsTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+
+    def test_put_get(self):
+        snapshots = GroupSnapshots(self._dir)
+        self.assertIsNone(snapshots.get("1,account"))
+        snapshots.put("1,account", _OLD_GROUPS)
+        self.assertEqual(GroupSnapshots(self._dir).get("1,account"), _OLD_GROUPS)
+        self.assertIsNone(snapshots.get("1,other"))
+
+
+    def test_disabled(self):
+        snapshots = GroupSnapshots(None)
+        snapshots.put("1,account", _OLD_GROUPS)
+        self.assertIsNone(snapshots.get("1,account"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from HttpPool import HttpPool
+from StandInServer import StandInServer
+
+# General python modules
+import http.client
+from time import sleep
+import unittest
+from urllib.error import HTTPError
+
+
+class HttpPoolTest(unittest.TestCase):
+    def setUp(self):
+        self._server = StandInServer(lambda request: (200, {}, request.body or b"ok"))
+        self._pool = HttpPool((5, 5), 60, 300)
+
+
+    def tearDown(self):
+        self._pool.close()
+        self._server.close()
+
+
+    def _get(self, data=None):
+        with self._pool.request(self._server.url + "/v2/test", data) as response:
+            return response.read()
+
+
+    def _drop_idle_connections(self):
+        # makes the server close the connection after the next response, as it would with an idle timeout
+        self._server.drop_connections = True
+        self._get()
+        self._server.drop_connections = False
+        # give the server time to actually close it
+        sleep(0.1)
+
+
+    def test_reuse(self):
+        self.assertEqual(self._get(), b"ok")
+        self.assertEqual(self._get(), b"ok")
+        self.assertEqual([reused for _, _, reused in self._pool.get_timings()], [False, True])
+        self.assertEqual(self._server.connections, 1)
+
+
+    def test_stale_connection(self):
+        self._drop_idle_connections()
+        # the request is retried with a new connection
+        self.assertEqual(self._get(), b"ok")
+        self.assertEqual(len(self._server.requests), 2)
+        self.assertEqual(self._server.connections, 2)
+
+
+    def test_no_upload_retry(self):
+        self._get()
+        self._server.handler = lambda request: None
+        # the server got the upload before it closed the connection, so it's not sent again
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self._get(b"data")
+        self.assertEqual(len(self._server.requests), 2)
+        # the next request gets a new connection
+        self._server.handler = lambda request: (200, {}, request.body)
+        self.assertEqual(self._get(b"data"), b"data")
+        self.assertEqual(self._server.connections, 2)
+
+
+    def test_download_retry(self):
+        self._get()
+        self._server.handler = lambda request: None
+        # a download is retried once with a new connection, which then fails too
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self._get()
+        self.assertEqual(len(self._server.requests), 3)
+        self.assertEqual(self._server.connections, 2)
+
+
+    def test_not_modified(self):
+        self._server.handler = lambda request: (304, {}, b"")
+        with self._pool.request(self._server.url + "/v2/test", headers={'If-None-Match': "etag"}) as response:
+            self.assertEqual(response.status, 304)
+        self._server.handler = lambda request: (200, {}, b"ok")
+        self.assertEqual(self._get(), b"ok")
+        self.assertEqual(self._server.connections, 1)
+
+
+    def test_error_status(self):
+        self._server.handler = lambda request: (500, {}, b"error")
+        with self.assertRaises(HTTPError) as context:
+            self._get()
+        self.assertEqual(context.exception.code, 500)
+        # the connection isn't reused after an error
+        self._server.handler = lambda request: (200, {}, b"ok")
+        self.assertEqual(self._get(), b"ok")
+        self.assertEqual([reused for _, _, reused in self._pool.get_timings()], [False, False])
+
+
+    def test_chunked_upload(self):
+        self.assertEqual(self._get(lambda: iter([b"ab", b"", b"cd"])), b"abcd")
+        self.assertTrue(self._server.requests[0].is_chunked)
+        self.assertEqual(self._server.requests[0].body, b"abcd")
+        # the connection is reused after a chunked upload
+        self.assertEqual(self._get(), b"ok")
+        self.assertEqual(self._server.connections, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+# This file is part of the TSM Desktop Application.
+#
+# The TSM Desktop Application is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The TSM Desktop Application is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the TSM Desktop Application.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Local modules
+from SalesFormat import SALES_FORMAT_VERSION, encode_sales, split_sales
+
+# General python modules
+from itertools import accumulate
+import json
+import random
+import unittest
+import zlib
+
+
+def _decode_sales(encoded):
+    # the inverse of encode_sales() (as done by the server)
+    save_times = list(accumulate(encoded['saveTimes']))
+    rows = []
+    item_id = 0
+    index = 0
+    for item_delta, count in zip(encoded['items'], encoded['counts']):
+        item_id += item_delta
+        # the first sale of each item is relative to the base time and the rest to the previous sale
+        sale_time = encoded['baseTime']
+        for _ in range(count):
+            sale_time += encoded['time'][index]
+            row = [item_id, encoded['price'][index], encoded['stackSize'][index], encoded['quantity'][index], sale_time, save_times[encoded['saveTime'][index]], encoded['type'][index]]
+            rows.append(row)
+            index += 1
+    return rows
+
+
+def _get_sales(seed, count, save_times=(1500000000, 1500003600, 1500090000)):
+    rand = random.Random(seed)
+    return [[rand.randint(1, 200000), rand.randint(1, 10 ** 7), rand.randint(1, 20), rand.randint(1, 5), rand.randint(1400000000, 1500000000), rand.choice(save_times), rand.choice(["Auction", "Vendor"])] for _ in range(count)]
+
+
+class EncodeSalesTest(unittest.TestCase):
+    def _check_round_trip(self, rows):
+        encoded = json.loads(json.dumps(encode_sales(rows)))
+        self.assertEqual(encoded['version'], SALES_FORMAT_VERSION)
+        self.assertEqual(sorted(_decode_sales(encoded)), sorted(rows))
+
+
+    def test_round_trip(self):
+        self._check_round_trip(_get_sales(1, 1000))
+
+
+    def test_empty(self):
+        self._check_round_trip([])
+
+
+    def test_single(self):
+        self._check_round_trip([[1, 2, 3, 4, 5, 6, "Auction"]])
+
+
+    def test_same_item(self):
+        # rows of the same item (including duplicates) which aren't in sale time order
+        rows = [[5, 100, 1, 1, 300, 10, "Auction"], [5, 100, 1, 1, 100, 10, "Auction"], [5, 100, 1, 1, 300, 20, "Auction"], [5, 90, 1, 1, 300, 10, "Vendor"]]
+        self._check_round_trip(rows)
+
+
+    def test_compression(self):
+        rows = _get_sales(2, 5000)
+        encoded_size = len(zlib.compress(json.dumps(encode_sales(rows)).encode("utf8")))
+        self.assertLess(encoded_size, len(zlib.compress(json.dumps(rows).encode("utf8"))))
+
+
+
+class SplitSalesTest(unittest.TestCase):
+    def _get_rows(self, save_times):
+        return [[i, 100, 1, 1, 1000 + i, save_time, "Auction"] for i, save_time in enumerate(save_times)]
+
+
+    def _get_save_times(self, chunks):
+        return [[row[5] for row in chunk] for chunk in chunks]
+
+
+    def test_empty(self):
+        self.assertEqual(list(split_sales([], 10, 1000)), [])
+
+
+    def test_single_chunk(self):
+        rows = self._get_rows([3, 1, 2])
+        self.assertEqual(self._get_save_times(split_sales(rows, 3, 10 ** 6)), [[1, 2, 3]])
+
+
+    def test_max_rows(self):
+        rows = self._get_rows([7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual(self._get_save_times(split_sales(rows, 3, 10 ** 6)), [[1, 2, 3], [4, 5, 6], [7]])
+
+
+    def test_max_bytes(self):
+        rows = self._get_rows([1, 2, 3, 4])
+        row_size = len(json.dumps(rows[0]))
+        self.assertTrue(all(len(json.dumps(x)) == row_size for x in rows))
+        # a chunk can be exactly the max size
+        self.assertEqual(self._get_save_times(split_sales(rows, 10, 2 * row_size)), [[1, 2], [3, 4]])
+        self.assertEqual(self._get_save_times(split_sales(rows, 10, 2 * row_size - 1)), [[1], [2], [3], [4]])
+
+
+    def test_same_save_time(self):
+        # rows with the same save time are never split across chunks, even if that goes over the limits
+        rows = self._get_rows([1, 2, 2, 2, 3, 3])
+        self.assertEqual(self._get_save_times(split_sales(rows, 2, 10 ** 6)), [[1], [2, 2, 2], [3, 3]])
+        self.assertEqual(self._get_save_times(split_sales(rows, 4, 10 ** 6)), [[1, 2, 2, 2], [3, 3]])
+
+
+    def test_keeps_all_rows(self):
+        rows = _get_sales(3, 1000, range(1500000000, 1500000200))
+        chunks = list(split_sales(rows, 100, 5000))
+        self.assertEqual(sorted(row for chunk in chunks for row in chunk), sorted(rows))
+        # each chunk only has sales saved after the ones in the previous chunks
+        for prev_chunk, chunk in zip(chunks, chunks[1:]):
+            self.assertLess(max(x[5] for x in prev_chunk), min(x[5] for x in chunk))
+
+
+if __name__ == "__main__":
+    unittest.main()